@@ -1,21 +1,34 @@
+import csv
+import json
 import logging
 import os
-import uuid
+import threading
+import time
 import xml.etree.ElementTree as ET
 from abc import ABC
-from datetime import date, datetime, timedelta
-from typing import Optional, Iterable
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import Optional, Iterable, Dict, List
 
 import MySQLdb
 import requests
-import xmltodict
 from bson import ObjectId
-from bson.son import SON
-from flask import Flask, Markup, flash, request, redirect, url_for, render_template
+from flask import Flask, Markup, Response, flash, request, redirect, url_for, render_template, stream_with_context
 from flask_pymongo import PyMongo
 
+from cache import TTLCache, MISSING
 from forms import FsrarForm, RestsForm, TicketForm, CreateUpdateUtm, StatusSelectOrder, MarkFormError, \
-    MarkForm, ChequeForm, WBRepealConfirmForm, RequestRepealForm, TTNForm
+    MarkForm, ChequeForm, WBRepealConfirmForm, RequestRepealForm, TTNForm, TTNBulkForm, \
+    MarkBulkForm
+from rests import iter_rests, rests_history, valid_alc_code
+from status_store import save_status, watch_status
+from tickets import refresh_ticket_index, search_tickets
+from ukm import UkmPools, PoolExhausted
+from utm_client import UtmClient, UtmUnavailable
+from jobs import JobQueue, ACTIVE_STATES
+from mark_rollups import rollup_totals
+from workers import RateLimiter, iter_bounded, run_parallel
+from xml_templates import XmlTemplates
 
 app = Flask(__name__)
 app.config.from_object('config.AppConfig')
@@ -23,6 +36,26 @@ app.secret_key = os.environ.get('FLASK_SECRET_KEY')
 app.config['MONGO_URI'] = os.environ.get('MONGO_URI')
 
 mongo = PyMongo(app)
+ukm_pools = UkmPools(
+    app.config['MYSQL_CONN'],
+    max_size=app.config['UKM_POOL_SIZE'],
+    idle_timeout=app.config['UKM_POOL_IDLE'],
+    ping_after=app.config['UKM_POOL_PING'],
+    wait=app.config['UKM_POOL_WAIT'],
+)
+utm_client = UtmClient(
+    connect_timeout=app.config['UTM_CONNECT_TIMEOUT'],
+    read_timeout=app.config['UTM_READ_TIMEOUT'],
+    retries=app.config['UTM_HTTP_RETRIES'],
+    backoff=app.config['UTM_HTTP_BACKOFF'],
+    pool_hosts=app.config['UTM_HTTP_POOL_HOSTS'],
+    pool_size=app.config['UTM_HTTP_POOL_SIZE'],
+)
+ukm_cheques_cache = TTLCache(max_size=app.config['UKM_CACHE_SIZE'], ttl=app.config['UKM_CACHE_TTL'])
+mark_verdicts_cache = TTLCache(max_size=app.config['MARK_CACHE_SIZE'], ttl=app.config['MARK_CACHE_TTL'])
+job_queue = JobQueue(mongo.db[app.config['MONGO_COL_QUE']])
+utm_send_limiter = RateLimiter(app.config['TTN_BULK_RATE'])
+xml_templates = XmlTemplates('xml', app.config['RESULT_FOLDER'] if app.config['XML_ARCHIVE'] else None)
 
 
 class MongoStorage(ABC):
@@ -53,14 +86,6 @@ class MongoStorage(ABC):
     def _create(self):
         mongo.db[self.__class__.__name__.lower()].insert_one(self._cleaned())
 
-    @classmethod
-    def _archive(cls):
-        return mongo.db[cls.__name__.lower()].update_many({}, {'$set': {'active': False}})
-
-    @classmethod
-    def _save_many(cls, results):
-        return mongo.db[cls.__name__.lower()].insert_many(results)
-
 
 class Utm(MongoStorage):
     """ УТМ
@@ -69,15 +94,17 @@ class Utm(MongoStorage):
 
     @classmethod
     def get_one(cls, **kwargs):
+        if list(kwargs) == ['fsrar']:
+            return utm_registry.get(kwargs['fsrar'])
         return Utm(**cls._get_one(**kwargs))
 
     @classmethod
     def get_all(cls):
-        return [Utm(**u) for u in cls._get_all()]
+        return utm_registry.all()
 
     @classmethod
     def get_active(cls):
-        return [Utm(**u) for u in cls._get_all(active=True)]
+        return utm_registry.active()
 
     @classmethod
     def get_ordered(cls, ordering):
@@ -85,7 +112,7 @@ class Utm(MongoStorage):
 
     @classmethod
     def utm_choices(cls):
-        return [(u.fsrar, f'{u.title} [{u.fsrar}] [{u.host}]') for u in cls.get_ordered('title')]
+        return utm_registry.choices()
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -143,6 +170,74 @@ class Utm(MongoStorage):
         return self._update() if self._id is None else self._create()
 
 
+class UtmRegistry(object):
+    """ Справочник УТМ в памяти процесса
+    Индекс по ФСРАР и готовый список для выпадающих списков. Раз в ttl секунд сверяется счетчик версии
+    в MongoDB, который увеличивается при каждом изменении справочника, и при расхождении справочник перечитывается
+    """
+    VERSION_ID = 'utm_registry'
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = 0.0
+        self._all: List[Utm] = []
+        self._by_fsrar: Dict[str, Utm] = {}
+        self._choices: list = []
+
+    def _current_version(self) -> int:
+        meta = mongo.db.meta.find_one({'_id': self.VERSION_ID})
+        return meta['version'] if meta else 0
+
+    def _load(self, version: int):
+        utms = [Utm(**u) for u in Utm._get_all()]
+        active = sorted((u for u in utms if u.active), key=lambda u: u.title or '')
+
+        self._all = utms
+        self._by_fsrar = {str(u.fsrar): u for u in utms}
+        self._choices = [(u.fsrar, f'{u.title} [{u.fsrar}] [{u.host}]') for u in active]
+        self._version = version
+        logging.info(f'Справочник УТМ загружен, версия {version}: {len(utms)}')
+
+    def _refresh(self):
+        if time.monotonic() - self._checked < self.ttl:
+            return
+
+        with self._lock:
+            if time.monotonic() - self._checked < self.ttl:
+                return
+
+            version = self._current_version()
+            if version != self._version:
+                self._load(version)
+            self._checked = time.monotonic()
+
+    def invalidate(self):
+        """ Вызывается после изменения справочника: увеличивает версию для всех процессов и сбрасывает свой кэш """
+        mongo.db.meta.update_one({'_id': self.VERSION_ID}, {'$inc': {'version': 1}}, upsert=True)
+        self._checked = 0.0
+
+    def get(self, fsrar) -> Optional[Utm]:
+        self._refresh()
+        return self._by_fsrar.get(str(fsrar))
+
+    def all(self) -> List[Utm]:
+        self._refresh()
+        return list(self._all)
+
+    def active(self) -> List[Utm]:
+        self._refresh()
+        return [u for u in self._all if u.active]
+
+    def choices(self) -> list:
+        self._refresh()
+        return list(self._choices)
+
+
+utm_registry = UtmRegistry(app.config['UTM_REGISTRY_TTL'])
+
+
 class Result(MongoStorage):
     """ Результаты опроса УТМ
     С главной страницы получаем:
@@ -156,15 +251,38 @@ class Result(MongoStorage):
 
     """
 
+    POLL_ID = 'status_poll'
+    FORCE_ID = 'status_force'
+
+    @classmethod
+    def save_many(cls, results: Iterable['Result'], active: Iterable[str]) -> int:
+        """ Сохранение опроса: текущее состояние в status обновляется только при изменениях,
+        изменения пишутся в журнал status_changes. Время опроса хранится в meta: всего и по каждому УТМ (polled),
+        чтобы опрос без изменений не переписывал документы status. active - ФСРАР ИД активных УТМ реестра
+        """
+        results = [vars(r) for r in results]
+        changed = save_status(mongo.db.status, mongo.db.status_changes, results, active)
+        mongo.db.meta.update_one({'_id': cls.POLL_ID}, {'$set': {
+            'date': datetime.now(),
+            'count': len(results),
+            'changed': changed,
+            'polled': {r['fsrar']: r['date'] for r in results},
+        }}, upsert=True)
+        return changed
+
     @classmethod
-    def save_many(cls, results: Iterable['Result']):
-        cls._archive()
-        return cls._save_many([vars(r) for r in results])
+    def last_poll(cls) -> Optional[dict]:
+        return mongo.db.meta.find_one({'_id': cls.POLL_ID})
 
     @classmethod
-    def add_many(cls, results: Iterable[dict]):
-        cls._archive()
-        return cls._save_many(results)
+    def request_poll(cls, fsrar: str):
+        """ Внеочередной опрос УТМ, get_status забирает запросы на каждом шаге расписания """
+        mongo.db.meta.update_one({'_id': cls.FORCE_ID}, {'$addToSet': {'fsrar': fsrar}}, upsert=True)
+
+    @classmethod
+    def take_poll_requests(cls) -> List[str]:
+        requested = mongo.db.meta.find_one_and_update({'_id': cls.FORCE_ID}, {'$set': {'fsrar': []}})
+        return requested['fsrar'] if requested else []
 
     def __init__(self, utm=None, **kwargs):
         super().__init__(**kwargs)
@@ -194,10 +312,6 @@ class Result(MongoStorage):
         self.active = True
 
 
-def get_xml_template(filename: str) -> str:
-    return os.path.join('xml/', filename)
-
-
 def get_limit(field: str, max_limit: int, default_limit: int) -> int:
     """ Лимитер, валидирует поле или устанавливает значение по умолчанию """
     return int(field) if field.isdigit() and int(field) < max_limit else default_limit
@@ -212,34 +326,14 @@ def humanize_date(iso_date: str) -> str:
     return (iso_date + timedelta(hours=7)).strftime('%Y-%m-%d %H:%M')
 
 
-def create_unique_xml(fsrar: str, content: str, path: str) -> str:
-    tree = ET.parse(path)
-    root = tree.getroot()
-    root[0][0].text = fsrar
-    root[1][0][0][0][1].text = content
-    path = os.path.join(app.config['RESULT_FOLDER'], f'TTNQuery_{uuid.uuid4()}.xml')
-    tree.write(path)
-    return path
-
-
-def create_unique_mark_xml(fsrar: str, mark: str, path: str) -> str:
-    tree = ET.parse(path)
-    root = tree.getroot()
-    root[0][0].text = fsrar
-    root[1][0][0].text = mark
-    path = os.path.join(app.config['RESULT_FOLDER'], f'QueryFilter_{uuid.uuid4()}.xml')
-    tree.write(path)
-    return path
-
-
 def send_xml(url: str, files):
     err = None
     try:
-        r = requests.post(url, files=files)
+        r = utm_client.post(url, files=files)
         if ET.fromstring(r.text).find('sign') is None:
             err = ET.fromstring(r.text).find('error').text
 
-    except requests.ConnectionError:
+    except UtmUnavailable:
         err = 'УТМ недоступен'
 
     return err
@@ -247,39 +341,179 @@ def send_xml(url: str, files):
 
 def send_xml_cheque(url: str, files) -> str:
     try:
-        response = requests.post(url, files=files)
+        response = utm_client.post(url, files=files)
         reply = ET.fromstring(response.text)
         if reply.find('url') is not None:
             return reply.find('url').text
         else:
             return reply.find('error').text
 
-    except requests.ConnectionError:
+    except UtmUnavailable:
         return 'Нет связи'
 
 
-def clean_documents(url: str):
-    counter = 0
+# Действия с TTN: шаблон, адрес в УТМ, префикс архива, формат даты документа, постоянные поля шаблона
+TTN_ACTIONS = {
+    'resend': ('ttn.xml', '/opt/in/QueryResendDoc', 'TTNQuery', None, {}),
+    'reject': ('reject.xml', '/opt/in/WayBillAct_v3', 'TTNReject', '%Y-%m-%d', {'is_accept': 'Rejected'}),
+    'repeal_wb': ('wbrepeal.xml', '/opt/in/RequestRepealWB', 'WBRepeal', '%Y-%m-%dT%H:%M:%S', {}),
+    'repeal_aco': ('acorepeal.xml', '/opt/in/RequestRepealACO', 'ACORepeal', '%Y-%m-%dT%H:%M:%S', {}),
+    'repeal_awo': ('aworepeal.xml', '/opt/in/RequestRepealAWO', 'AWORepeal', '%Y-%m-%dT%H:%M:%S', {}),
+    'confirm_repeal': ('wbrepealconfirm.xml', '/opt/in/ConfirmRepealWB', 'WBrepealConfirm', '%Y-%m-%d',
+                       {'is_confirm': 'Accepted'}),
+    'reject_repeal': ('wbrepealconfirm.xml', '/opt/in/ConfirmRepealWB', 'WBrepealConfirm', '%Y-%m-%d',
+                      {'is_confirm': 'Rejected'}),
+}
+
+
+def send_ttn_action(utm: Utm, action: str, wbregid: str) -> Optional[str]:
+    """ Отправка документа по TTN (или акту) в УТМ, возвращаем ошибку УТМ или None """
+    template, url_suffix, prefix, date_format, fields = TTN_ACTIONS[action]
+    values = {'fsrar': utm.fsrar, 'wbregid': wbregid, 'regid': wbregid, **fields}
+    if date_format is not None:
+        values['date'] = datetime.now().strftime(date_format)
+
+    return send_xml(utm.url() + url_suffix, xml_templates.render_files(template, prefix, **values))
+
+
+def query_mark(utm: Utm, mark: str) -> (Optional[str], bool):
+    """ Запрос QueryFilter по марке в локальном справочнике УТМ
+    Возвращаем ответ УТМ и признак того, что это ответ УТМ, а не ошибка связи
+    """
+    files = xml_templates.render_files('queryfilter.xml', 'QueryFilter', fsrar=utm.fsrar, mark=mark)
+    try:
+        r = utm_client.post(utm.url() + '/opt/in/QueryFilter', files=files)
+    except UtmUnavailable:
+        return 'УТМ недоступен', False
+    except UnicodeError:
+        return 'Ошибка в URL проверьте переменные окружения', False
+
+    res = None
+    for sign in ET.fromstring(r.text).iter('{http://fsrar.ru/WEGAIS/QueryFilter}result'):
+        res = sign.text
+    mark_verdicts_cache.set((utm.fsrar, mark), res)
+    return res, True
+
+
+def check_mark_cached(utm: Utm, mark: str) -> (Optional[str], bool):
+    """ Ответ УТМ по марке, недавние ответы берутся из кэша. Второе значение - ответ взят из кэша """
+    verdict = mark_verdicts_cache.get((utm.fsrar, mark))
+    if verdict is not MISSING:
+        return verdict, True
+
+    verdict, _ = query_mark(utm, mark)
+    return verdict, False
+
+
+def parse_ttn_rows(text: str, fsrar: str, action: str) -> List[dict]:
+    """ Строки пакетной отправки: WBRegID на строку для выбранного УТМ и действия или CSV fsrar, wbregid, действие
+    Повторы отбрасываются, ошибки разбора строки попадают в поле error
+    """
+    rows, seen = [], set()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        cells = [c.strip() for c in next(csv.reader([line], delimiter=';' if ';' in line else ','))]
+        if cells[0].lower() == 'fsrar':
+            continue
+
+        if len(cells) == 1:
+            row = {'fsrar': fsrar, 'wbregid': cells[0], 'action': action}
+        elif len(cells) == 3:
+            row = {'fsrar': cells[0], 'wbregid': cells[1], 'action': cells[2]}
+        else:
+            rows.append({'fsrar': '', 'wbregid': line, 'action': '', 'utm': None,
+                         'error': 'Ожидается WBRegID или fsrar, wbregid, действие'})
+            continue
+
+        key = (row['fsrar'], row['wbregid'], row['action'])
+        if key in seen:
+            continue
+        seen.add(key)
+
+        row['utm'] = Utm.get_one(fsrar=row['fsrar'])
+        if row['utm'] is None:
+            row['error'] = 'УТМ не найден'
+        elif row['action'] not in TTN_ACTIONS:
+            row['error'] = 'Неизвестное действие'
+        else:
+            row['error'] = None
+        rows.append(row)
+
+    return rows
+
+
+def send_ttn_row(row: dict) -> str:
+    """ Отправка строки пакетной отправки TTN из фоновой задачи, результат для отчета """
+    if row['error'] is not None:
+        return row['error']
+
+    utm = Utm.get_one(fsrar=row['fsrar'])
+    if utm is None:
+        return 'УТМ не найден'
+
+    err = send_ttn_action(utm, row['action'], row['wbregid'])
+    return err if err is not None else 'OK'
+
+
+def wait_ttn_slot(row: dict):
+    """ Документы на один УТМ отправляются не чаще TTN_BULK_RATE в секунду, ожидание не входит в TTN_BULK_TIMEOUT """
+    if row['error'] is None:
+        utm_send_limiter.wait(row['fsrar'])
+
+
+def clean_documents(url: str) -> (int, int):
+    """ Удаление ReplyNATTN и TTNHISTORYF2REG из исходящих УТМ, удаление идет в несколько потоков
+    Возвращаем кол-во удаленных документов и ошибок удаления
+    """
     url_out = url + '/opt/out'
     doc_types = ('ReplyNATTN', 'TTNHISTORYF2REG')
-    response = requests.get(url_out)
+    response = utm_client.get(url_out)
     tree = ET.fromstring(response.text)
-    for u in tree.findall('url'):
-        if any(ext in u.text for ext in doc_types):
-            requests.delete(u.text)
-            counter += 1
-    return counter
+    urls = [u.text for u in tree.findall('url') if any(ext in u.text for ext in doc_types)]
+
+    def delete(doc_url: str) -> bool:
+        try:
+            utm_client.delete(doc_url)
+            return True
+        except requests.RequestException as e:
+            logging.warning(f'Не удалось удалить {doc_url}: {e}')
+            return False
+
+    deleted = sum(run_parallel(delete, urls, app.config['UTM_CLEAN_DELETE_WORKERS']))
+    return deleted, len(urls) - deleted
+
+
+def clean_utm(utm: Utm) -> str:
+    """ Удаление Форм 2 с одного УТМ, результат для таблицы """
+    try:
+        deleted, failed = clean_documents(utm.url())
+    except Exception as e:
+        return f'недоступен {e}'
+    return f'удалено {deleted}, ошибок {failed}' if failed else f'удалено {deleted}'
+
+
+def request_nattn(utm: Utm) -> str:
+    """ Отправка запроса необработанных документов QueryNATTN """
+    files = xml_templates.render_files('nattn.xml', 'TTNQuery', fsrar=utm.fsrar, code=utm.fsrar)
+    err = send_xml(utm.url() + '/opt/in/QueryNATTN', files)
+
+    log = f'QueryNATTN: Отправлен запрос {utm.title} [{utm.fsrar}]: {err if err is not None else "OK"}'
+    logging.info(log)
+    return log
 
 
 def find_last_nattn(url: str) -> str:
     url_out = url + '/opt/out/ReplyNATTN'
     try:
-        response = requests.get(url_out)
+        response = utm_client.get(url_out)
         tree = ET.fromstring(response.text)
         for nattn_url in reversed(tree.findall('url')):
             if 'ReplyNATTN' in nattn_url.text:
                 return nattn_url.text
-    except requests.exceptions.ConnectionError:
+    except UtmUnavailable:
         flash('Ошибка подключения к УТМ')
 
 
@@ -287,7 +521,7 @@ def parse_reply_nattn(url: str):
     ttn_list, date_list, doc_list, nattn_list = [], [], [], []
     if url is not None:
         try:
-            response = requests.get(url)
+            response = utm_client.get(url)
             tree = ET.fromstring(response.text)
 
             for elem in tree.iter('{http://fsrar.ru/WEGAIS/ReplyNoAnswerTTN}WbRegID'):
@@ -306,45 +540,72 @@ def parse_reply_nattn(url: str):
     return nattn_list
 
 
-def get_mysql_data(ukm_hostname: str, query: str) -> Optional[list]:
+def get_mysql_data(ukm_hostname: str, query: str, args: Optional[Iterable] = None) -> Optional[list]:
     """ Выполнение запроса к MySQL """
 
     try:
-        mysql_config = app.config['MYSQL_CONN']
-        mysql_config['host'] = ukm_hostname
-
-        connection = MySQLdb.connect(**mysql_config)
-        with connection.cursor() as cursor:
-            cursor.execute(query)
-            data = cursor.fetchall()
+        with ukm_pools.get(ukm_hostname).connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, args)
+                data = cursor.fetchall()
 
-        connection.close()
-
-    except (MySQLdb.OperationalError, TypeError) as e:
+    except (MySQLdb.OperationalError, PoolExhausted, TypeError) as e:
         logging.error(e)
         data = None
 
     return data
 
 
-def get_cheques_from_ukm(host: str, mark: str) -> Optional[list]:
-    """ Получение списка чеков"""
-    query = f"""
-        SELECT 
-            trm_out_receipt_header.date,
-            trm_out_receipt_item.name,
-            trm_out_receipt_header.type,
-            trm_out_receipt_footer.result, 
-            trm_out_receipt_egais.url
-          FROM trm_out_receipt_item_egais
-          left outer JOIN trm_out_receipt_item ON trm_out_receipt_item_egais.id = trm_out_receipt_item.id AND trm_out_receipt_item_egais.cash_id = trm_out_receipt_item.cash_id
-          left outer JOIN trm_out_receipt_header ON trm_out_receipt_item.receipt_header = trm_out_receipt_header.id AND trm_out_receipt_item.cash_id = trm_out_receipt_header.cash_id
-          left outer JOIN trm_out_receipt_footer ON trm_out_receipt_item.receipt_header = trm_out_receipt_footer.id AND trm_out_receipt_item.cash_id = trm_out_receipt_footer.cash_id
-          left outer JOIN trm_out_receipt_egais ON trm_out_receipt_item.receipt_header = trm_out_receipt_egais.id AND trm_out_receipt_item.cash_id = trm_out_receipt_egais.cash_id
-          where egais_barcode like '%{mark}%'
-          order by trm_out_receipt_header.date asc
+def get_cheques_from_ukm(host: str, marks: Iterable[str]) -> Optional[Dict[str, list]]:
+    """ Получение списков чеков по маркам, сгруппированных по марке
+    Марки сравниваются точно и передаются параметрами, запросы по UKM_MARKS_CHUNK марок.
+    Результаты кэшируются по (хост, марка), пустые на меньший срок. None, если УКМ недоступен
     """
-    return get_mysql_data(host, query)
+    cheques = {}
+    for mark in dict.fromkeys(marks):
+        cheques[mark] = ukm_cheques_cache.get((host, mark))
+
+    marks = [m for m, c in cheques.items() if c is MISSING]
+    logging.debug(f'Кэш чеков УКМ {host}: {ukm_cheques_cache.stats()}')
+    if not marks:
+        return cheques
+
+    cheques.update({m: [] for m in marks})
+    by_barcode = {m.upper(): m for m in marks}
+    chunk_size = app.config['UKM_MARKS_CHUNK']
+
+    for i in range(0, len(marks), chunk_size):
+        chunk = marks[i:i + chunk_size]
+        query = f"""
+            SELECT 
+                trm_out_receipt_item_egais.egais_barcode,
+                trm_out_receipt_header.date,
+                trm_out_receipt_item.name,
+                trm_out_receipt_header.type,
+                trm_out_receipt_footer.result, 
+                trm_out_receipt_egais.url
+              FROM trm_out_receipt_item_egais
+              left outer JOIN trm_out_receipt_item ON trm_out_receipt_item_egais.id = trm_out_receipt_item.id AND trm_out_receipt_item_egais.cash_id = trm_out_receipt_item.cash_id
+              left outer JOIN trm_out_receipt_header ON trm_out_receipt_item.receipt_header = trm_out_receipt_header.id AND trm_out_receipt_item.cash_id = trm_out_receipt_header.cash_id
+              left outer JOIN trm_out_receipt_footer ON trm_out_receipt_item.receipt_header = trm_out_receipt_footer.id AND trm_out_receipt_item.cash_id = trm_out_receipt_footer.cash_id
+              left outer JOIN trm_out_receipt_egais ON trm_out_receipt_item.receipt_header = trm_out_receipt_egais.id AND trm_out_receipt_item.cash_id = trm_out_receipt_egais.cash_id
+              where trm_out_receipt_item_egais.egais_barcode in ({', '.join(['%s'] * len(chunk))})
+              order by trm_out_receipt_header.date asc
+        """
+        data = get_mysql_data(host, query, chunk)
+        if data is None:
+            return None
+
+        for row in data:
+            mark = by_barcode.get(row['egais_barcode'].upper())
+            if mark is not None:
+                cheques[mark].append(row)
+
+        for mark in chunk:
+            ttl = app.config['UKM_CACHE_TTL'] if cheques[mark] else app.config['UKM_CACHE_EMPTY_TTL']
+            ukm_cheques_cache.set((host, mark), cheques[mark], ttl)
+
+    return cheques
 
 
 def compose_cheque_link(ukm_cheque: dict) -> str:
@@ -373,23 +634,54 @@ def catch_error_line(line: str, re_err):
 
 def process_errors(errors: list, full: bool, ukm: str):
     """ Обработка,запись, формирование сообщений
-    full означает, что нужно получать чеки по маркам УКМ
+    full означает, что нужно получать чеки по маркам УКМ, одним запросом на все марки
     """
-    current_marks = []
+    # Вывести марки без дублей
+    unique_errors = {}
+    for e in errors:
+        unique_errors.setdefault(e.get('mark'), e)
+
+    # Опционально вывести чеки по маркам
+    marks = [m for m in unique_errors if m is not None]
+    ukm_cheques = get_cheques_from_ukm(ukm, marks) if full and marks else {}
+
     current_results = []
+    for mark, e in unique_errors.items():
+        if ukm_cheques is None:
+            cheques = None if mark is not None else []
+        else:
+            cheques = ukm_cheques.get(mark, [])
+        current_results.append(compose_error_result(e['date'], mark, e['error'], cheques))
 
-    for e in errors:
-        mark, date, err = e['mark'], e['date'], e['error']
-        # Вывести марки без дублей
-        if mark not in current_marks:
-            # Опционально вывести чеки по маркам
-            cheques = get_cheques_from_ukm(ukm, mark) if full and mark is not None else []
+    return current_results, len(unique_errors)
+
+
+def scan_utm_log(utm: Utm, full: bool, reader: str = 'web') -> (str, list):
+    """ Разбор журнала чеков УТМ: итоговая строка и ошибки, full - с чеками УКМ по маркам
+    reader - ключ сохраненной позиции журнала, у страницы и фоновой задачи позиции разные
+    """
+    from get_logs import parse_log_incremental, parse_errors
 
-            mark_text_result = compose_error_result(date, mark, err, cheques)
-            current_results.append(mark_text_result)
-            current_marks.append(e['mark'])
+    _, errors_found, checks, err = parse_log_incremental(utm, utm.log_dir() + app.config['UTM_LOG_NAME'], reader,
+                                                         history=True)
+    errors_objects = parse_errors(errors_found, utm)
+    error_results, marks = process_errors(errors_objects, full, utm.ukm_host())
+    summary = err if err is not None else f'Всего чеков: {checks}, ошибок {len(errors_objects)}, уникальных {marks}'
+    return summary, error_results
 
-    return current_results, len(current_marks)
+
+def job_status(params: dict, job_id: str) -> Optional[dict]:
+    """ Задача из очереди для страницы, пока задача не завершена, страница обновляется """
+    job = job_queue.get(job_id)
+    if job is None:
+        flash('Задача не найдена')
+        return None
+
+    params['job'] = job
+    if job['state'] in ACTIVE_STATES:
+        params['refresh'] = 3
+        params['workers_alive'] = job_queue.workers_alive(app.config['QUEUE_STALE'])
+    return job
 
 
 @app.route('/')
@@ -409,18 +701,11 @@ def resend_ttn():
     }
 
     if request.method == 'POST':
-        file = 'ttn.xml'
-        xml = get_xml_template(file)
-
         wbregid = request.form['wbregid'].strip()
         utm = Utm.get_one(fsrar=request.form['fsrar'])
         form.fsrar.data = utm.fsrar
 
-        query = create_unique_xml(utm.fsrar, wbregid, xml)
-        url = utm.url() + '/opt/in/QueryResendDoc'
-
-        files = {'xml_file': (file, open(query, 'rb'), 'application/xml')}
-        err = send_xml(url, files)
+        err = send_ttn_action(utm, 'resend', wbregid)
         log = f'QueryResendDoc: {wbregid} отправлена {utm.title} [{utm.fsrar}]: {err if err is not None else "OK"}'
         logging.info(log)
         flash(log)
@@ -440,25 +725,11 @@ def reject_ttn():
     }
 
     if request.method == 'POST':
-        file = 'reject.xml'
-        filepath = get_xml_template(file)
-
         wbregid = request.form['wbregid'].strip()
         utm = Utm.get_one(fsrar=request.form['fsrar'])
         form.fsrar.data = utm.fsrar
 
-        url = utm.url() + '/opt/in/WayBillAct_v3'
-
-        tree = ET.parse(filepath)
-        root = tree.getroot()
-        root[0][0].text = utm.fsrar
-        root[1][0][0][0].text = 'Rejected'
-        root[1][0][0][2].text = str(date.today())
-        root[1][0][0][3].text = wbregid
-        filepath = os.path.join(app.config['RESULT_FOLDER'], f'TTNReject_{uuid.uuid4()}.xml')
-        tree.write(filepath)
-        files = {'xml_file': (file, open(filepath, 'rb'), 'application/xml')}
-        err = send_xml(url, files)
+        err = send_ttn_action(utm, 'reject', wbregid)
         log = f'WayBillAct_v3: {wbregid} отправлен отзыв/отказ от {utm.title} [{utm.fsrar}]: {err if err is not None else "OK"}'
         logging.info(log)
         flash(log)
@@ -477,40 +748,13 @@ def request_repeal():
         'form': form,
     }
     if request.method == 'POST':
-        options = {
-            'WB': {
-                'file': 'wbrepeal.xml',
-                'url': '/opt/in/RequestRepealWB'
-            },
-            'ACO': {
-                'file': 'acorepeal.xml',
-                'url': '/opt/in/RequestRepealACO'
-            },
-            'AWO': {
-                'file': 'aworepeal.xml',
-                'url': '/opt/in/RequestRepealAWO'
-            },
-        }
         repeal_type = request.form['r_type']
-        repeal_data = options.get(repeal_type)
-        filepath = get_xml_template(repeal_data['file'])
         wbregid = request.form['wbregid'].strip()
-        request_date = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
         utm = Utm.get_one(fsrar=request.form['fsrar'])
-        url = utm.url() + repeal_data['url']
         form.fsrar.data = utm.fsrar
         form.r_type.data = repeal_type
 
-        tree = ET.parse(filepath)
-        root = tree.getroot()
-        root[0][0].text = utm.fsrar
-        root[1][0][0].text = utm.fsrar
-        root[1][0][2].text = request_date
-        root[1][0][3].text = wbregid
-        filepath = os.path.join(app.config['RESULT_FOLDER'], f'{repeal_type}Repeal_{uuid.uuid4()}.xml')
-        tree.write(filepath)
-        files = {'xml_file': (repeal_data['file'], open(filepath, 'rb'), 'application/xml')}
-        err = send_xml(url, files)
+        err = send_ttn_action(utm, f'repeal_{repeal_type.lower()}', wbregid)
         log = f'RequestRepeal{repeal_type}: {wbregid} отправлен запрос на распроведение {repeal_type} {utm.title} [{utm.fsrar}]: {err if err is not None else "OK"}'
         flash(log)
         logging.info(log)
@@ -530,35 +774,62 @@ def confirm_repeal():
     }
 
     if request.method == 'POST':
-        file = 'wbrepealconfirm.xml'
-        filepath = get_xml_template(file)
         wbregid = request.form['wbregid'].strip()
         is_confirm = request.form['is_confirm']
         utm = Utm.get_one(fsrar=request.form['fsrar'])
         form.is_confirm.data = request.form['is_confirm']
         form.fsrar.data = utm.fsrar
 
-        url = utm.url() + '/opt/in/ConfirmRepealWB'
-
-        request_date = datetime.now().strftime("%Y-%m-%d")
+        err = send_ttn_action(utm, 'confirm_repeal' if is_confirm == 'Accepted' else 'reject_repeal', wbregid)
+        log = f'ConfirmRepealWB: {wbregid} подтверждения распроведения {utm.title} [{utm.fsrar}]: {err if err is not None else "OK"}'
+        flash(log)
+        logging.info(log)
 
-        tree = ET.parse(filepath)
-        root = tree.getroot()
-        root[0][0].text = utm.fsrar
-        root[1][0][0][0].text = is_confirm
-        root[1][0][0][2].text = request_date
-        root[1][0][0][3].text = wbregid
-        root[1][0][0][4].text = is_confirm
-        filepath = os.path.join(app.config['RESULT_FOLDER'], f'WBrepealConfirm_{uuid.uuid4()}.xml')
+    return render_template(**params)
 
-        tree.write(filepath)
 
-        files = {'xml_file': (file, open(filepath, 'rb'), 'application/xml')}
+@app.route('/ttn/bulk', methods=['GET', 'POST'])
+def bulk_ttn():
+    form = TTNBulkForm()
+    form.fsrar.choices = Utm.utm_choices()
+    params = {
+        'template_name_or_list': 'ttn_bulk.html',
+        'title': 'Пакетная отправка TTN',
+        'description': 'Список WBRegID для выбранного УТМ или CSV: fsrar, wbregid, действие',
+        'form': form,
+    }
 
-        err = send_xml(url, files)
-        log = f'ConfirmRepealWB: {wbregid} подтверждения распроведения {utm.title} [{utm.fsrar}]: {err if err is not None else "OK"}'
-        flash(log)
-        logging.info(log)
+    if request.method == 'POST':
+        form.fsrar.data = request.form['fsrar']
+        form.action.data = request.form['action']
+
+        text = request.form.get('rows', '')
+        upload = request.files.get('file')
+        if upload is not None and upload.filename:
+            text += '\n' + upload.read().decode('utf-8-sig')
+
+        rows = parse_ttn_rows(text, request.form['fsrar'], request.form['action'])
+        if not rows:
+            flash('Нет строк для отправки')
+            return render_template(**params)
+
+        max_rows = app.config['TTN_BULK_MAX_ROWS']
+        if len(rows) > max_rows:
+            flash(f'Обработаны первые {max_rows} строк из {len(rows)}')
+            rows = rows[:max_rows]
+
+        # Отправка с ограничением частоты занимает минуты, поэтому выполняется фоновой задачей
+        job_rows = [{k: row[k] for k in ('fsrar', 'wbregid', 'action', 'error')} for row in rows]
+        job_id = job_queue.enqueue('ttn_bulk', f'Пакетная отправка TTN: {len(rows)} строк', {'rows': job_rows})
+        return redirect(url_for('bulk_ttn', job=job_id))
+
+    elif request.args.get('job'):
+        job = job_status(params, request.args['job'])
+        if job is not None:
+            results = [(r['fsrar'], r['title'], r['wbregid'], r['action'], r['result']) for r in job['results']]
+            ok = sum(1 for r in results if r[-1] == 'OK')
+            params['summary'] = f'Успешно {ok}, ошибок {len(results) - ok}'
+            params['results'] = results
 
     return render_template(**params)
 
@@ -590,35 +861,22 @@ def check_nattn():
             params['ttn_list'] = ttn_list
 
         if 'request' in request.form:
-            file = 'nattn.xml'
-            xml = get_xml_template(file)
-
-            utm = Utm.get_one(fsrar=request.form['fsrar'])
-            form.fsrar.data = utm.fsrar
+            flash(Markup(request_nattn(utm)))
 
-            url = utm.url() + '/opt/in/QueryNATTN'
+        if 'request_all' in request.form:
+            job_id = job_queue.enqueue('nattn_request', 'Запрос необработанных документов со всех УТМ')
+            return redirect(url_for('check_nattn', job=job_id))
 
-            query = create_unique_xml(utm.fsrar, utm.fsrar, xml)
-            files = {'xml_file': (file, open(query, 'rb'), 'application/xml')}
-            err = send_xml(url, files)
-
-            log = f'QueryNATTN: Отправлен запрос {utm.title} [{utm.fsrar}]: {err if err is not None else "OK"}'
-
-            logging.info(log)
-            flash(Markup(log))
+    elif request.args.get('job'):
+        job = job_status(params, request.args['job'])
+        if job is not None:
+            params['results'] = [(r['title'], r['result']) for r in job['results']]
 
     return render_template(**params)
 
 
 @app.route('/service', methods=['GET', 'POST'])
 def cleanup_utm():
-    def clean(utm: Utm):
-        # todo: внести clean_documents
-        try:
-            return utm.title, clean_documents(utm.url())
-        except Exception as e:
-            return utm.title, f'недоступен {e}'
-
     form = FsrarForm()
     form.fsrar.choices = Utm.utm_choices()
     params = {
@@ -632,15 +890,20 @@ def cleanup_utm():
         results = []
         if 'select' in request.form:
             utm = Utm.get_one(fsrar=request.form['fsrar'])
-            results.append(clean(utm))
+            results.append((utm.title, clean_utm(utm)))
             form.fsrar.data = utm.fsrar
 
         elif 'all' in request.form:
-            for utm in Utm.get_active():
-                results.append(clean(utm))
+            job_id = job_queue.enqueue('service_clean', 'Удаление Форм 2 со всех УТМ')
+            return redirect(url_for('cleanup_utm', job=job_id))
 
         params['results'] = results
 
+    elif request.args.get('job'):
+        job = job_status(params, request.args['job'])
+        if job is not None:
+            params['results'] = [(r['title'], r['result']) for r in job['results']]
+
     return render_template(**params)
 
 
@@ -673,13 +936,9 @@ def send_cheque():
         node.set('barcode', request.form['bottle'].strip())
         node.set('price', request.form['price'].strip())
 
-        # done, writing to xml file
-        file = 'cheque.xml'
-        tree = ET.ElementTree(document)
-        tree.write(get_xml_template(file), encoding='utf-8', xml_declaration=True)
-
-        # send xml and write log
-        files = {'xml_file': (file, open(get_xml_template(file), 'rb'), 'application/xml')}
+        # done, send xml and write log
+        data = ET.tostring(document, encoding='utf-8', xml_declaration=True)
+        files = xml_templates.files('cheque.xml', data, 'Cheque')
         result = send_xml_cheque(utm.xml_url(), files)
 
         log = f"Cheque: ТТ {utm.title} [{utm.fsrar}]: {request.form['bottle']}  цена: {request.form['price']}: {result}"
@@ -702,25 +961,11 @@ def check_mark():
         'form': form,
     }
     if request.method == 'POST':
-        res = None
-        file = 'queryfilter.xml'
-        xml = get_xml_template(file)
-        url_suffix = '/opt/in/QueryFilter'
         mark = request.form['mark'].strip()
         utm = Utm.get_one(fsrar=request.form['fsrar'])
         form.fsrar.data = utm.fsrar
 
-        query = create_unique_mark_xml(utm.fsrar, mark, xml)
-        url = utm.url() + url_suffix
-        files = {'xml_file': (file, open(query, 'rb'), 'application/xml')}
-        try:
-            r = requests.post(url, files=files)
-            for sign in ET.fromstring(r.text).iter('{http://fsrar.ru/WEGAIS/QueryFilter}result'):
-                res = sign.text
-        except requests.ConnectionError:
-            res = 'УТМ недоступен'
-        except UnicodeError:
-            res = 'Ошибка в URL проверьте переменные окружения'
+        res, _ = query_mark(utm, mark)
         log = f'Проверка марки: {utm.title} [{utm.fsrar}] {mark[:16]}...{mark[-16:]} {res}'
         flash(log)
         logging.info(log)
@@ -728,6 +973,59 @@ def check_mark():
     return render_template(**params)
 
 
+@app.route('/mark/bulk', methods=['GET', 'POST'])
+def check_marks_bulk():
+    form = MarkBulkForm()
+    form.fsrar.choices = Utm.utm_choices()
+    params = {
+        'template_name_or_list': 'mark_bulk.html',
+        'title': 'Проверка списка марок УТМ',
+        'description': 'Запрос наличия марок в УТМ списком или файлом, по одной марке на строку',
+        'form': form,
+    }
+    if request.method != 'POST':
+        return render_template(**params)
+
+    utm = Utm.get_one(fsrar=request.form['fsrar'])
+    form.fsrar.data = utm.fsrar
+
+    text = request.form.get('marks', '')
+    upload = request.files.get('file')
+    if upload is not None and upload.filename:
+        text += '\n' + upload.read().decode('utf-8-sig')
+
+    marks = list(dict.fromkeys(text.split()))
+    if not marks:
+        flash('Нет марок для проверки')
+        return render_template(**params)
+
+    max_marks = app.config['MARK_BULK_MAX']
+    if len(marks) > max_marks:
+        flash(f'Будут проверены первые {max_marks} марок из {len(marks)}')
+        marks = marks[:max_marks]
+
+    # Страница отдается частями: начало с заголовком таблицы, строки по мере ответов УТМ, окончание
+    params['total'] = len(marks)
+    head, tail = render_template(**params).split('<!-- rows -->', 1)
+
+    def generate():
+        yield head
+        checked, cached = 0, 0
+        for i, result, e in iter_bounded(lambda m: check_mark_cached(utm, m), marks,
+                                         app.config['MARK_BULK_WORKERS'], app.config['MARK_BULK_TIMEOUT']):
+            verdict, from_cache = result if e is None else (f'ошибка {e}', False)
+            checked += 1
+            cached += from_cache
+            yield render_template('mark_row.html', n=checked, mark=marks[i], verdict=verdict, cached=from_cache)
+
+        log = f'Проверка марок: {utm.title} [{utm.fsrar}] проверено {checked}, из кэша {cached}'
+        logging.info(log)
+        yield render_template('mark_row.html', summary=log)
+        yield tail
+
+    return Response(stream_with_context(generate()), mimetype='text/html', headers={'X-Accel-Buffering': 'no'})
+
+
 @app.route('/utm/logs', methods=['GET', 'POST'])
 def get_utm_errors():
     form = FsrarForm()
@@ -739,25 +1037,32 @@ def get_utm_errors():
         'description': 'Поиск ошибок в журнале чеков УТМ',
         'form': form,
     }
+    scanned = None
     if request.method == 'POST':
-        from get_logs import parse_log_for_errors, parse_errors
-        results = dict()
-
-        log_name = 'transport_transaction.log'
-        params['date'] = datetime.now().strftime(app.config['HUMAN_DATE_FORMAT'])
         form.fsrar.data = request.form['fsrar']
 
-        all_utm = request.form.get('all', False)
-        utm = Utm.get_active() if all_utm else [Utm.get_one(fsrar=request.form['fsrar']), ]
+        if request.form.get('all', False):
+            job_id = job_queue.enqueue('utm_logs', 'Поиск ошибок в журналах всех УТМ')
+            return redirect(url_for('get_utm_errors', job=job_id))
 
-        for u in utm:
-            transport_log = u.log_dir() + log_name
-            utm_header = f'{u.title} <a target="_blank" href="{url_for("get_utm_errors")}?fsrar={u.fsrar}">{u.fsrar}</a> '
+        utm = Utm.get_one(fsrar=request.form['fsrar'])
+        params['date'] = datetime.now().strftime(app.config['HUMAN_DATE_FORMAT'])
+        try:
+            scanned = [(utm.fsrar, utm.title, scan_utm_log(utm, True))]
+        except Exception as e:
+            scanned = [(utm.fsrar, utm.title, f'Журнал не обработан: {e}')]
+
+    elif request.args.get('job'):
+        job = job_status(params, request.args['job'])
+        if job is not None:
+            params['date'] = job['created'].strftime(app.config['HUMAN_DATE_FORMAT'])
+            scanned = [(r['fsrar'], r['title'], r['result']) for r in job['results']]
 
-            errors_found, checks, err = parse_log_for_errors(transport_log)
-            errors_objects = parse_errors(errors_found, u)
-            error_results, marks = process_errors(errors_objects, not all_utm, u.ukm_host())
-            summary = err if err is not None else f'Всего чеков: {checks}, ошибок {len(errors_objects)}, уникальных {marks}'
+    if scanned is not None:
+        results = dict()
+        for fsrar, title, scan in scanned:
+            utm_header = f'{title} <a target="_blank" href="{url_for("get_utm_errors")}?fsrar={fsrar}">{fsrar}</a> '
+            summary, error_results = scan if isinstance(scan, (list, tuple)) else (scan, [])
             results[utm_header + summary] = error_results
 
         params['results'] = results
@@ -790,35 +1095,19 @@ def get_rests():
         date_till = form.date_till.data or datetime.now()
         date_from = form.date_from.data or date_till - timedelta(days=7)
 
-        query_filter = {'is_retail': is_retail, 'fsrar': utm.fsrar}
-
-        if date_from or date_till:
-            period = {}
-
-            if date_from:
-                period.update({'$gt': date_from})
-
-            if date_till:
-                period.update({'$lt': date_till})
-
-            query_filter.update({f'date': period})
-
-        query = list(mongo.db.rests.find(query_filter).sort('date'))
-
         if form.by_request.data:
-            params['results'] = query
+            snapshots = iter_rests(mongo.db.rests, utm.fsrar, is_retail, date_from, date_till)
+            params['results'] = [{'date': d, 'rests': r} for d, r in snapshots]
 
         else:
-            date_res = dict()
-            for res_ in query:
-                date_ = res_['date']
-                for code_, qty_ in res_['rests'].items():
-                    if not alc_code or code_ in alc_code:
-                        if code_ in date_res.keys():
-                            date_res[code_].update({date_: qty_})
-                        else:
-                            date_res[code_] = {date_: qty_}
-            params['results'] = date_res
+            invalid = [code for code in alc_code if not valid_alc_code(code)]
+            if invalid:
+                flash(f'Некорректные алкокоды, не учитываются: {", ".join(invalid)}')
+                alc_code = [code for code in alc_code if valid_alc_code(code)]
+
+            if alc_code or not invalid:
+                snapshots = iter_rests(mongo.db.rests, utm.fsrar, is_retail, date_from, date_till, alc_code)
+                params['results'] = rests_history(snapshots)
 
         params['is_retail'] = is_retail
         params['by_request'] = by_request
@@ -843,25 +1132,22 @@ def get_tickets():
 
     if request.method == 'POST':
 
-        results = list()
         doc = request.form['search'].strip()
         limit = request.form['limit'].strip()
         limit = int(limit) if limit.isdigit() and int(limit) < 5000 else 1000
         utm = Utm.get_one(fsrar=request.form['fsrar'])
         form.fsrar.data = int(utm.fsrar)
 
-        for root, dirs, files in os.walk(utm.path):
-            files = [fi for fi in files if fi.find("Ticket") > 0]
-            files.sort(reverse=True)
+        try:
+            pending = refresh_ticket_index(mongo.db.tickets, mongo.db.ticket_scans, utm.fsrar, utm.path,
+                                           app.config['TICKET_INDEX_TTL'], app.config['TICKET_INDEX_MAX_FILES'])
+            if pending:
+                flash(f'Индекс квитанций построен не полностью, еще {pending} файлов будут прочитаны '
+                      f'при следующих поисках')
+        except OSError as e:
+            flash(f'Не удалось обновить индекс квитанций {utm.path}: {e}')
 
-            for reply_rests in files[:limit]:
-                with open(os.path.join(root, reply_rests), encoding="utf8") as f:
-                    raw_data = f.read()
-                    if doc in raw_data:
-                        ticket_dict = xmltodict.parse(raw_data)
-                        ticket_data = ticket_dict.get('ns:Documents').get('ns:Document').get('ns:Ticket')
-                        if ticket_data is not None:
-                            results.append(ticket_data)
+        results = search_tickets(mongo.db.tickets, utm.fsrar, doc, limit)
 
         params['results'] = results
 
@@ -890,6 +1176,7 @@ def add_utm():
     if request.method == 'POST':
         data = dict(request.form)
         result = mongo.db.utm.insert_one(data).inserted_id
+        utm_registry.invalidate()
         return redirect(url_for('edit_utm', utm_id=result))
 
     return render_template(**params)
@@ -912,9 +1199,11 @@ def edit_utm(utm_id):
         utm['active'] = True if data.get('active') else False
 
         mongo.db.utm.replace_one({'_id': utm.pop('_id')}, utm)
+        utm_registry.invalidate()
 
     if request.method == 'DELETE':
         mongo.db.utm.delete_many({'_id': utm.pop('_id')})
+        utm_registry.invalidate()
         return redirect(url_for('list_utm'))
 
     form.process(**utm)
@@ -928,6 +1217,8 @@ def status():
     form = StatusSelectOrder()
     form.ordering.data = ordering
     ordering_direction = -1 if ordering == 'error' else 1
+    results = list(mongo.db.status.find({'active': True}).sort(ordering, ordering_direction))
+    poll = Result.last_poll()
 
     params = {
         'template_name_or_list': 'status.html',
@@ -935,21 +1226,70 @@ def status():
         'description': 'Результат последней проверки УТМ',
         'ord': ordering,
         'form': form,
-        'results': mongo.db.result.find({'active': True}).sort(ordering, ordering_direction)
+        'poll': poll,
+        'polled': poll.get('polled', {}) if poll else {},
+        'results': results,
+        'since': max((u['changed'] for u in results), default=datetime.now()).isoformat(),
     }
 
+    utm_poll = Utm.get_one(fsrar=request.form['poll']) if 'poll' in request.form else None
+    if utm_poll is not None:
+        Result.request_poll(utm_poll.fsrar)
+        flash(f'{utm_poll.title} [{utm_poll.fsrar}] будет опрошен в течение {app.config["STATUS_TICK"]} с')
+
     update_filter = request.form.get('filter')
     if update_filter is not None:
         utm_filter = Utm.get_one(fsrar=update_filter)
         if utm_filter is not None:
             try:
-                flash(f"{utm_filter.title}[{utm_filter.fsrar}]: {requests.get(utm_filter.reset_filter_url()).text}")
-            except (requests.ConnectionError, requests.ReadTimeout) as e:
+                flash(f"{utm_filter.title}[{utm_filter.fsrar}]: {utm_client.get(utm_filter.reset_filter_url()).text}")
+            except UtmUnavailable as e:
                 flash(f'Не удалось выполнить запрос обновления {e}, УТМ недоступен')
 
     return render_template(**params)
 
 
+@app.route('/status/stream')
+def status_stream():
+    """ Server-Sent Events для /status: строки таблицы только для изменившихся УТМ
+    Поток занимает поток (greenlet) сервера, поэтому закрывается через STATUS_STREAM_MAX_AGE:
+    EventSource переподключается сам и передает Last-Event-ID, с которого поток продолжается
+    """
+    try:
+        since = datetime.fromisoformat(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    except (TypeError, ValueError):
+        since = datetime.now()
+    deadline = time.monotonic() + app.config['STATUS_STREAM_MAX_AGE']
+
+    def events():
+        yield f'retry: {app.config["STATUS_STREAM_POLL"] * 2000:.0f}\n\n'
+        last = since
+        with closing(watch_status(mongo.db.status, since, app.config['STATUS_STREAM_POLL'],
+                                  app.config['STATUS_STREAM_KEEPALIVE'])) as docs:
+            for doc in docs:
+                # Закрываем только на границе даты изменения, чтобы после переподключения по Last-Event-ID
+                # не потерять УТМ с той же датой, что последняя отданная строка
+                expired = time.monotonic() >= deadline
+                if doc is None:
+                    if expired:
+                        return
+                    yield ': keepalive\n\n'
+                    continue
+                if expired and doc['changed'] != last:
+                    return
+                last = doc['changed']
+
+                html = ''
+                if doc.get('active'):
+                    poll = Result.last_poll()
+                    html = render_template('status_row.html', u=doc, polled=poll.get('polled', {}) if poll else {})
+                data = json.dumps({'fsrar': doc['fsrar'], 'html': html}, ensure_ascii=False)
+                yield f'id: {doc["changed"].isoformat()}\nevent: row\ndata: {data}\n\n'
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/xml/', methods=['GET', 'POST'])
 def test_utm():
     """ Тестовый УТМ для "подписи" чеков """
@@ -964,29 +1304,6 @@ def get_utm_error_stats():
         choices.insert(0, (0, 'Выберите...'))
         return choices
 
-    def pipeline_group_by(field: str, start_date: datetime, limit: Optional[int] = None, ):
-        """ Итоги сгруппированны по полям, с указанной даты, опционально лимит """
-        result = [
-            {"$match": {
-                "date": {
-                    "$gte": start_date
-                },
-            }
-            },
-            {"$group": {
-                "_id": {
-                    f"{field}": f"${field}",
-                },
-                "count": {"$sum": 1}
-            }
-            },
-            {"$sort": SON([("count", -1), ("_id", -1)])},
-
-        ]
-        if limit:
-            result.append({"$limit": limit})
-        return result
-
     def validate_arg(arg: str) -> bool:
         """ Исключаем невалидные аргументы """
         return False if arg in ['0', '', ' ', '', None] else True
@@ -995,13 +1312,14 @@ def get_utm_error_stats():
         """ ИД для динамических полей выбора, у которых нет естественных идентификаторов """
         return hash(title) % 256
 
-    last_days = app.config['MARK_ERRORS_LAST_DAYS']
+    last_days = max(request.args.get('days', app.config['MARK_ERRORS_LAST_DAYS'], type=int), 1)
     last_utms = app.config['MARK_ERRORS_LAST_UTMS']
 
     form = MarkFormError()
     form.fsrar.choices = Utm.utm_choices()
     add_default_choice(form.fsrar.choices)
     form.fsrar.data = int(request.args.get('fsrar', 0))
+    form.days.data = last_days
     week_ago = datetime.now() - timedelta(days=last_days)
 
     params = {
@@ -1011,18 +1329,19 @@ def get_utm_error_stats():
         'description': f'Статистика ошибок за {last_days}',
     }
     col = mongo.db.marks
-    # Т.к поле с типом ошибок динамическое, мы сначала получаем этот список из MongoDB
-    errors_types = list(col.aggregate(pipeline_group_by('error', week_ago)))
+    # Т.к поле с типом ошибок динамическое, мы сначала получаем этот список из MongoDB.
+    # Итоги считаются по дневным итогам marks_daily, а не по всем ошибкам за период
+    errors_types = rollup_totals(mongo.db.marks_daily, 'error', week_ago)
     # Собираем выпадайку с вариантами, добавляем туда пустой элемент
     choices_list = list((short_choices_hash(x['_id']['error']), x['_id']['error']) for x in errors_types)
     form.error.choices = add_default_choice(choices_list)
 
     params['error_type_total'] = errors_types
-    params['fsrar_total'] = col.aggregate(pipeline_group_by('title', week_ago, last_utms))
+    params['fsrar_total'] = rollup_totals(mongo.db.marks_daily, 'title', week_ago, last_utms)
 
     if request.args:
         # Если были переданы параметры, то собираем пайплайн фильтра ошибок из них
-        pipeline_mark = {k: v for k, v in dict(request.args).items() if validate_arg(v)}
+        pipeline_mark = {k: v for k, v in dict(request.args).items() if k != 'days' and validate_arg(v)}
         error_arg = request.args.get('error')
         # Т.к. ошибки у нас динамические, берем из словаря по ИД
         if validate_arg(error_arg):
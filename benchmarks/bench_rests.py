@@ -0,0 +1,122 @@
+""" Сравнение разбора ReplyRests_v2: xmltodict по всему документу и потоковый RestsParser
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_rests --positions 100000
+
+Создает синтетический ReplyRests_v2 с указанным количеством позиций, каждая реализация
+выполняется в отдельном процессе, чтобы пиковая память (maxrss) не смешивалась.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from xmltodict import parse
+
+from rests import humanize_date, read_rests
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<ns:Documents Version="1.0" xmlns:ns="http://fsrar.ru/WEGAIS/WB_DOC_SINGLE_01"
+              xmlns:rst="http://fsrar.ru/WEGAIS/ReplyRests_v2" xmlns:pref="http://fsrar.ru/WEGAIS/ProductRef_v2"
+              xmlns:oref="http://fsrar.ru/WEGAIS/ClientRef_v2">
+<ns:Owner><ns:FSRAR_ID>030000000001</ns:FSRAR_ID></ns:Owner>
+<ns:Document><ns:ReplyRests_v2>
+<rst:RestsDate>2020-05-12T10:15:22.123</rst:RestsDate>
+<rst:Products>
+'''
+POSITION = '''<rst:StockPosition>
+<rst:Quantity>{quantity}</rst:Quantity>
+<rst:InformF1RegId>FA-000000{n:012d}</rst:InformF1RegId>
+<rst:InformF2RegId>FB-000000{n:012d}</rst:InformF2RegId>
+<rst:Product>
+<pref:FullName>Водка "Тестовая особая" крепость 40% объем 0,5 л, позиция {n}</pref:FullName>
+<pref:AlcCode>{n:019d}</pref:AlcCode>
+<pref:Capacity>0.5000</pref:Capacity>
+<pref:AlcVolume>40.000</pref:AlcVolume>
+<pref:ProductVCode>200</pref:ProductVCode>
+<pref:Producer><oref:UL><oref:ClientRegId>010000000001</oref:ClientRegId>
+<oref:FullName>Общество с ограниченной ответственностью "Ликероводочный завод"</oref:FullName>
+<oref:ShortName>ООО "ЛВЗ"</oref:ShortName><oref:INN>7700000000</oref:INN><oref:KPP>770001001</oref:KPP>
+<oref:address><oref:Country>643</oref:Country><oref:RegionCode>77</oref:RegionCode>
+<oref:description>Россия, Москва, ул. Заводская, д. 1</oref:description></oref:address>
+</oref:UL></pref:Producer>
+</rst:Product>
+</rst:StockPosition>
+'''
+FOOTER = '''</rst:Products>
+</ns:ReplyRests_v2></ns:Document>
+</ns:Documents>
+'''
+
+
+def legacy_read_rests(filename: str) -> (object, dict):
+    """ Прежняя реализация get_rests: весь документ в память и xmltodict """
+    with open(filename, encoding="utf8") as f:
+        rests_dict = parse(f.read())
+        document = rests_dict.get('ns:Documents').get('ns:Document')
+        doc_rests = document.get('ns:ReplyRests_v2')
+        rests_date = humanize_date(doc_rests.get('rst:RestsDate'))
+        doc_products = doc_rests.get('rst:Products')
+
+        rests = dict()
+        if isinstance(doc_products, dict):
+            for pos in doc_products.get('rst:StockPosition'):
+                rests[pos.get('rst:Product').get('pref:AlcCode')] = float(pos.get('rst:Quantity'))
+
+    return rests_date, rests
+
+
+def generate_rests(filename: str, positions: int):
+    with open(filename, 'w', encoding='utf8') as f:
+        f.write(HEADER)
+        for n in range(positions):
+            f.write(POSITION.format(n=n, quantity=n % 97))
+        f.write(FOOTER)
+
+
+def measure(func, filename: str, queue):
+    start = time.perf_counter()
+    rests_date, rests = func(filename)
+    elapsed = time.perf_counter() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024
+    queue.put((elapsed, maxrss, rests_date, len(rests), sum(rests.values())))
+
+
+def run(func, filename: str):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(func, filename, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--positions', type=int, default=100000, help='количество позиций в документе')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, '200512101522_ReplyRests_v2.xml')
+        generate_rests(filename, args.positions)
+        size_mb = os.path.getsize(filename) / 1024 / 1024
+        print(f'Документ: {size_mb:.1f} МБ, позиций {args.positions}')
+
+        results = {}
+        for name, func in (('xmltodict', legacy_read_rests), ('RestsParser', read_rests)):
+            elapsed, maxrss, rests_date, codes, total = run(func, filename)
+            results[name] = (rests_date, codes, total)
+            print(f'{name:>11}: {elapsed:6.2f} с, пик памяти {maxrss / 1024:7.1f} МБ, '
+                  f'дата {rests_date}, алкокодов {codes}')
+
+        if len(set(results.values())) > 1:
+            print('ВНИМАНИЕ: результаты реализаций различаются')
+
+
+if __name__ == '__main__':
+    main()
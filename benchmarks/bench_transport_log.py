@@ -0,0 +1,126 @@
+""" Сравнение разбора transport_transaction.log: построчный readlines() и потоковый LogScanner
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_transport_log --size-mb 1024
+
+Создает синтетический журнал указанного размера во временном каталоге, каждая реализация
+выполняется в отдельном процессе, чтобы пиковая память (maxrss) не смешивалась.
+"""
+import argparse
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from transport_log import parse_log_for_errors
+
+LINES = (
+    '{time} INFO  ru.centerinform.crypto.TransportTransaction - Получен чек. Касса: 0100001, смена: 12, номер: {n}\n',
+    '{time} INFO  ru.centerinform.crypto.TransportTransaction - Подписан документ, время подписи 12 мс\n',
+    '{time} INFO  ru.centerinform.crypto.TransportTransaction - Отправлен документ на сервер ЕГАИС, размер 4096\n',
+    '{time} INFO  ru.centerinform.crypto.TransportTransaction - Соединение с сервером ЕГАИС установлено\n',
+)
+ERROR_LINE = ('{time} ERROR ru.centerinform.crypto.TransportTransaction - <error>Ошибка: Чек: '
+              '22N00001XJ5Q1KOKTDG0MBV1008001000{n:04d}00000000000000000000000000000000 '
+              '(Марка не числится на балансе)</error>\n')
+ERROR_EVERY = 1000
+
+
+def legacy_parse_log_for_errors(filename: str) -> (list, int, str):
+    """ Прежняя реализация: весь журнал в памяти, regex и strptime на каждой строке """
+    re_error = re.compile('<error>(.*)</error>')
+    error_mark_events = []
+    cheques_counter = 0
+
+    with open(filename, encoding="utf8") as file:
+        cheque_text = 'Получен чек.'
+
+        for line in file.readlines():
+            if cheque_text in line:
+                cheques_counter += 1
+
+            else:
+                error_result = re_error.search(line)
+                if error_result is not None:
+                    error_time = datetime.strptime(line[0:19], '%Y-%m-%d %H:%M:%S')
+                    error_mark_events.append([error_time, error_result.groups()[0]])
+
+    return error_mark_events, cheques_counter, None
+
+
+def current_parse_log_for_errors(filename: str) -> (list, int, str):
+    errors, cheques, err, _ = parse_log_for_errors(filename)
+    return errors, cheques, err
+
+
+def generate_log(filename: str, size: int):
+    """ Синтетический журнал: в основном чеки и служебные строки, каждая ERROR_EVERY строка с ошибкой """
+    moment = datetime(2020, 5, 12)
+    written = 0
+    n = 0
+
+    with open(filename, 'w', encoding='utf8') as file:
+        while written < size:
+            block = []
+            for _ in range(10000):
+                n += 1
+                moment += timedelta(milliseconds=50)
+                template = ERROR_LINE if n % ERROR_EVERY == 0 else LINES[n % len(LINES)]
+                block.append(template.format(time=moment.strftime('%Y-%m-%d %H:%M:%S,%f')[:23], n=n % 10000))
+            data = ''.join(block)
+            file.write(data)
+            written += len(data.encode('utf8'))
+
+
+def measure(func, filename: str, queue):
+    start = time.perf_counter()
+    errors, cheques, _ = func(filename)
+    elapsed = time.perf_counter() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024
+    queue.put((elapsed, maxrss, len(errors), cheques, errors[:3] + errors[-3:]))
+
+
+def run(func, filename: str):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(func, filename, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=1024, help='размер синтетического журнала, МБ')
+    parser.add_argument('--skip-legacy', action='store_true', help='не запускать прежнюю реализацию')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'transport_transaction.log')
+        generate_log(filename, args.size_mb * 1024 * 1024)
+        size_mb = os.path.getsize(filename) / 1024 / 1024
+        print(f'Журнал: {size_mb:.0f} МБ')
+
+        implementations = [('LogScanner', current_parse_log_for_errors)]
+        if not args.skip_legacy:
+            implementations.insert(0, ('readlines', legacy_parse_log_for_errors))
+
+        results = {}
+        for name, func in implementations:
+            elapsed, maxrss, errors, cheques, sample = run(func, filename)
+            results[name] = (errors, cheques, sample)
+            print(f'{name:>10}: {elapsed:7.2f} с, {size_mb / elapsed:7.1f} МБ/с, '
+                  f'пик памяти {maxrss / 1024:7.1f} МБ, ошибок {errors}, чеков {cheques}')
+
+        if len({repr(r) for r in results.values()}) > 1:
+            print('ВНИМАНИЕ: результаты реализаций различаются')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+""" Сравнение разбора главной страницы УТМ: XPath по номерам div (как Grab doc.select) и HomePage
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_utm_home --pages benchmarks/pages --repeat 200
+
+В каталоге --pages (по умолчанию benchmarks/pages) ожидаются главные страницы УТМ, сохраненные
+benchmarks.save_utm_pages: <fsrar>.html и, если есть, <fsrar>_gost.html. Страницы декодируются
+кодировкой из index.csv или --encoding, как Grab doc.unicode_body(). Для каждой страницы выводятся
+поля, в которых прежний и новый разбор расходятся, и поля, взятые HomePage по номерам строк.
+
+Если сохраненных страниц нет, используются синтетические страницы с теми же подписями, что в
+HOME_LABELS: они годятся только для замера скорости и не проверяют подписи настоящих УТМ.
+Прежний путь воспроизводит Grab: дерево lxml, отдельный XPath на каждое поле и компиляция
+регулярных выражений сертификата на каждый вызов.
+"""
+import argparse
+import csv
+import os
+import re
+import time
+
+import lxml.html
+
+from utm_home import HomePage, last_date, parse_certificate
+
+ROW = '<div class="row"><div class="col-md-3">{label}</div><div class="col-md-9">{value}</div></div>\n'
+ROWS = (
+    ('Версия ПО', '4.2.0'),
+    ('Changeset', 'b8f6f4a3'),
+    ('Дата сборки', '2021-03-03 12:00'),
+    ('Проверка RSA', 'RSA сертификат pki.fsrar.ru соответствует контуру'),
+    ('Лицензия', 'Лицензия на вид деятельности действует'),
+    ('Статус обмена', 'Работает'),
+    ('Чеки', 'Отсутствуют неотправленные чеки'),
+    ('Сертификат RSA', 'Действителен с 2020-06-01 по 2021-06-01'),
+    ('Сертификат ГОСТ', 'Действителен с 2020-05-15 по 2021-08-15'),
+)
+PAGES_DIR = os.path.join(os.path.dirname(__file__), 'pages')
+PAGE = '''<!DOCTYPE html><html><head><title>УТМ</title>
+<script>{script}</script></head><body>
+<nav>{menu}</nav>
+<div class="container"><div id="home">
+{rows}</div>
+<div id="RSA"><div>RSA</div><div>CN=030000000001-00000000000000 030000000001-00-030000000001_1</div></div>
+<div id="filterMsgDiv">Обновление настроек не требуется</div>
+{footer}</div></body></html>
+'''
+CERTIFICATE = '''<html><body><pre>
+SURNAME=Иванов, GIVENNAME=Иван Иванович, CN="ООО ""Ромашка""", O=Ромашка, C=RU, INN=007700000000
+</pre></body></html>'''
+
+
+def synthetic_pages():
+    script = 'var x = 1;\n' * 200
+    menu = ''.join(f'<a href="/page{n}">Раздел {n}</a>' for n in range(40))
+    footer = '<p>' + 'Универсальный транспортный модуль ' * 50 + '</p>'
+    rsa_problem = list(ROWS)
+    rsa_problem[3] = ('Проверка RSA', 'RSA сертификат не соответствует контуру')
+    rsa_problem.insert(4, ('Проблема с RSA', 'Обратитесь в техническую поддержку'))
+
+    return [(f'synthetic_{n}', PAGE.format(script=script, menu=menu, footer=footer,
+                                           rows=''.join(ROW.format(label=label, value=value) for label, value in rows)),
+             CERTIFICATE)
+            for n, rows in enumerate((ROWS, rsa_problem))]
+
+
+def saved_pages(path: str, encoding: str) -> list:
+    """ (имя, страница, сертификат) для сохраненных страниц, декодированных в текст """
+    encodings = {}
+    index = os.path.join(path, 'index.csv')
+    if os.path.exists(index):
+        with open(index, newline='') as f:
+            encodings = {row[0]: row[2] for row in csv.reader(f) if len(row) > 2 and row[2]}
+
+    def read(name: str) -> str:
+        with open(os.path.join(path, name), 'rb') as f:
+            return f.read().decode(encodings.get(name, encoding), errors='replace')
+
+    pages = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.html') and not name.endswith('_gost.html'):
+            gost = name[:-len('.html')] + '_gost.html'
+            certificate = read(gost) if os.path.exists(os.path.join(path, gost)) else CERTIFICATE
+            pages.append((name, read(name), certificate))
+    return pages
+
+
+def legacy_parse(page: str, certificate: str) -> dict:
+    """ Прежний parse_utm: отдельный XPath на каждое поле, номера div сдвигаются при проблеме с RSA """
+    tree = lxml.html.fromstring(page)
+
+    def select(xpath: str) -> str:
+        return ' '.join(tree.xpath(xpath)[0].text_content().split())
+
+    def last_date(date_string: str):
+        return re.findall(r'\d{4}-\d{2}-\d{2}', date_string)[-1]
+
+    result = {
+        'version': select('//*[@id="home"]/div[1]/div[2]'),
+        'change_set': select('//*[@id="home"]/div[2]/div[2]'),
+        'build': select('//*[@id="home"]/div[3]/div[2]'),
+        'rsa': select('//*[@id="RSA"]/div[2]'),
+    }
+    result['status'] = 'RSA сертификат pki.fsrar.ru соответствует контуру' == select('//*[@id="home"]/div[4]/div[2]')
+    div_inc = not result['status']
+    result['license'] = 'Лицензия на вид деятельности действует' == select(f'//*[@id="home"]/div[{5 + div_inc}]/div[2]')
+    result['filter'] = 'Обновление настроек не требуется' == select('//*[@id="filterMsgDiv"]')
+    result['gost'] = last_date(select(f'//*[@id="home"]/div[{9 + div_inc}]/div[2]'))
+    result['pki'] = last_date(select(f'//*[@id="home"]/div[{8 + div_inc}]/div[2]'))
+    result['cheques'] = select(f'// *[@id="home"]/div[{7 + div_inc}]/div[2]')
+
+    pre = ' '.join(lxml.html.fromstring(certificate).xpath('//pre')[0].text_content().split())
+    cn = re.compile(r'(?<=CN=)[^,]*')
+    name = re.compile(r'(?<=GIVENNAME=)[^,]*')
+    surname = re.compile(r'(?<=SURNAME=)[^,]*')
+    result['legal'] = cn.search(pre).group().replace('"', '').replace('\\', '').replace('ООО', '')[0:20]
+    result['surname'] = surname.search(pre).group()
+    result['given_name'] = name.search(pre).group()
+    return result
+
+
+def home_parse(page: str, certificate: str) -> dict:
+    """ HomePage: один обход #home и поля по подписям строк """
+    home = HomePage(page)
+    fields = home.fields
+    result = {
+        'version': fields['version'],
+        'change_set': fields['change_set'],
+        'build': fields['build'],
+        'rsa': home.rsa,
+        'status': home.status,
+        'license': home.license,
+        'filter': home.filter,
+        'gost': last_date(fields['gost']),
+        'pki': last_date(fields['pki']),
+        'cheques': fields['cheques'],
+    }
+    result.update(parse_certificate(certificate) or {})
+    return result
+
+
+def safe_parse(func, page: str, certificate: str) -> dict:
+    """ Разбор без исключения: прежний путь падает, если на странице нет div с нужным номером """
+    try:
+        return func(page, certificate)
+    except (IndexError, AttributeError, KeyError) as e:
+        return {'error': f'{type(e).__name__}: {e}'}
+
+
+def bench(func, pages, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, page, certificate in pages:
+            safe_parse(func, page, certificate)
+    return time.perf_counter() - start
+
+
+def compare(pages):
+    """ Поля, в которых прежний и новый разбор расходятся, поля, взятые по номерам строк,
+    и расхождения значения по подписи со значением по номеру строки
+    """
+    differs = 0
+    for name, page, certificate in pages:
+        old = safe_parse(legacy_parse, page, certificate)
+        new = safe_parse(home_parse, page, certificate)
+        fields = sorted(set(old) | set(new))
+        diff = {f: (old.get(f), new.get(f)) for f in fields if old.get(f) != new.get(f)}
+        home = HomePage(page)
+
+        if diff:
+            differs += 1
+            print(f'{name}: различаются поля')
+            for field, (old_value, new_value) in diff.items():
+                print(f'    {field}: XPath {old_value!r}, HomePage {new_value!r}')
+        if home.by_position:
+            print(f'{name}: по номерам строк {home.by_position}')
+        for field, (label_value, position_value) in home.conflicts.items():
+            print(f'{name}: {field} по подписи {label_value!r}, по номеру строки {position_value!r}')
+    print(f'Страниц с различиями: {differs} из {len(pages)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', default=PAGES_DIR, help='каталог с сохраненными страницами УТМ')
+    parser.add_argument('--encoding', default='utf-8', help='кодировка страниц, которых нет в index.csv')
+    parser.add_argument('--repeat', type=int, default=500, help='количество повторов разбора всех страниц')
+    args = parser.parse_args()
+
+    pages = saved_pages(args.pages, args.encoding) if os.path.isdir(args.pages) else []
+    if not pages:
+        print(f'Сохраненных страниц в {args.pages} нет, синтетические страницы проверяют только скорость, '
+              f'а не подписи настоящих УТМ')
+        pages = synthetic_pages()
+
+    compare(pages)
+
+    total = len(pages) * args.repeat
+    print(f'Страниц: {len(pages)}, повторов {args.repeat}, всего разборов {total}')
+    for name, func in (('XPath', legacy_parse), ('HomePage', home_parse)):
+        elapsed = bench(func, pages, args.repeat)
+        print(f'{name:>8}: {elapsed:6.2f} с, {elapsed / total * 1000:.3f} мс на страницу, '
+              f'{total / elapsed:8.0f} страниц/с')
+
+
+if __name__ == '__main__':
+    main()
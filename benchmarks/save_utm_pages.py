@@ -0,0 +1,48 @@
+""" Сохранение главных страниц и страниц сертификата ГОСТ с работающих УТМ для bench_utm_home
+
+Запуск из корня проекта:
+    python -m benchmarks.save_utm_pages --out benchmarks/pages
+    python -m benchmarks.save_utm_pages --out benchmarks/pages --fsrar 030000000001 030000000002
+
+Страницы сохраняются байтами как есть, без перекодирования, вместе с кодировкой из заголовка ответа:
+<fsrar>.html, <fsrar>_gost.html и index.csv (файл, fsrar, кодировка). Для проверки разбора нужны страницы
+в разных состояниях: обычная, без действующей лицензии, с необновленными настройками фильтра, с «Проблема с RSA».
+"""
+import argparse
+import csv
+import os
+
+from app import Utm, utm_client
+from utm_client import UtmUnavailable
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=os.path.join('benchmarks', 'pages'), help='каталог для страниц')
+    parser.add_argument('--fsrar', nargs='*', help='ФСРАР ИД УТМ, по умолчанию все активные')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    utms = [Utm.get_one(fsrar=f) for f in args.fsrar] if args.fsrar else Utm.get_active()
+
+    with open(os.path.join(args.out, 'index.csv'), 'a', newline='') as index:
+        writer = csv.writer(index)
+        for u in utms:
+            if u is None:
+                continue
+
+            for name, url in ((f'{u.fsrar}.html', u.build_url()), (f'{u.fsrar}_gost.html', u.gost_url())):
+                try:
+                    response = utm_client.get(url)
+                except UtmUnavailable as e:
+                    print(f'{u.fsrar} {url}: {e}')
+                    continue
+
+                with open(os.path.join(args.out, name), 'wb') as f:
+                    f.write(response.content)
+                writer.writerow([name, u.fsrar, response.encoding or ''])
+                print(f'{name}: {len(response.content)} байт, {response.encoding}')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,16 +9,56 @@ load_dotenv()
 class AppConfig(object):
     LOCAL_DOMAIN = os.environ.get('USERDNSDOMAIN', '.local')
     RESULT_FOLDER = os.environ.get('RESULT_FOLDER', 'results')
+    XML_ARCHIVE = bool(int(os.environ.get('XML_ARCHIVE', 1)))
     UTM_USE_DB = os.environ.get('UTM_USE_DB', False)
     UTM_PORT = os.environ.get('UTM_PORT', '8080')
     UTM_CONFIG = os.environ.get('UTM_CONFIG', 'config')
     UTM_LOG_PATH = os.environ.get('UTM_PORT', 'c$/utm/transporter/l/')
     UTM_LOG_NAME = os.environ.get('UTM_LOG_NAME', 'transport_transaction.log')
+    UTM_REGISTRY_TTL = int(os.environ.get('UTM_REGISTRY_TTL', 30))
+    UTM_POLL_WORKERS = int(os.environ.get('UTM_POLL_WORKERS', 32))
+    STATUS_INTERVAL = int(os.environ.get('STATUS_INTERVAL', 60))
+    STATUS_CERT_INTERVAL = int(os.environ.get('STATUS_CERT_INTERVAL', 3600))
+    STATUS_MAX_BACKOFF = int(os.environ.get('STATUS_MAX_BACKOFF', 1800))
+    STATUS_TICK = int(os.environ.get('STATUS_TICK', 5))
+    STATUS_STREAM_POLL = float(os.environ.get('STATUS_STREAM_POLL', 2))
+    STATUS_STREAM_KEEPALIVE = int(os.environ.get('STATUS_STREAM_KEEPALIVE', 15))
+    STATUS_STREAM_MAX_AGE = int(os.environ.get('STATUS_STREAM_MAX_AGE', 600))
+    UTM_CONNECT_TIMEOUT = int(os.environ.get('UTM_CONNECT_TIMEOUT', 5))
+    UTM_READ_TIMEOUT = int(os.environ.get('UTM_READ_TIMEOUT', 30))
+    UTM_HTTP_RETRIES = int(os.environ.get('UTM_HTTP_RETRIES', 2))
+    UTM_HTTP_BACKOFF = float(os.environ.get('UTM_HTTP_BACKOFF', 0.5))
+    UTM_HTTP_POOL_HOSTS = int(os.environ.get('UTM_HTTP_POOL_HOSTS', 512))
+    UTM_HTTP_POOL_SIZE = int(os.environ.get('UTM_HTTP_POOL_SIZE', 8))
+    UTM_LOG_WORKERS = int(os.environ.get('UTM_LOG_WORKERS', 16))
+    UTM_LOG_TIMEOUT = int(os.environ.get('UTM_LOG_TIMEOUT', 120))
+    UTM_CLEAN_WORKERS = int(os.environ.get('UTM_CLEAN_WORKERS', 16))
+    UTM_CLEAN_TIMEOUT = int(os.environ.get('UTM_CLEAN_TIMEOUT', 300))
+    UTM_CLEAN_DELETE_WORKERS = int(os.environ.get('UTM_CLEAN_DELETE_WORKERS', 4))
+    TTN_BULK_WORKERS = int(os.environ.get('TTN_BULK_WORKERS', 8))
+    TTN_BULK_RATE = float(os.environ.get('TTN_BULK_RATE', 2))
+    TTN_BULK_TIMEOUT = int(os.environ.get('TTN_BULK_TIMEOUT', 60))
+    TTN_BULK_MAX_ROWS = int(os.environ.get('TTN_BULK_MAX_ROWS', 1000))
+    MARK_BULK_WORKERS = int(os.environ.get('MARK_BULK_WORKERS', 4))
+    MARK_BULK_TIMEOUT = int(os.environ.get('MARK_BULK_TIMEOUT', 60))
+    MARK_BULK_MAX = int(os.environ.get('MARK_BULK_MAX', 5000))
+    MARK_CACHE_SIZE = int(os.environ.get('MARK_CACHE_SIZE', 50000))
+    MARK_CACHE_TTL = int(os.environ.get('MARK_CACHE_TTL', 300))
     DEFAULT_XML_PATH = os.environ.get('DEFAULT_XML_PATH')
 
     LOGFILE_DATE_FORMAT = '%Y_%m_%d'
     HUMAN_DATE_FORMAT = '%Y-%m-%d'
 
+    RESTS_KEYFRAME_DAYS = int(os.environ.get('RESTS_KEYFRAME_DAYS', 7))
+    RESTS_WORKERS = int(os.environ.get('RESTS_WORKERS', os.cpu_count() or 2))
+    RESTS_LIST_WORKERS = int(os.environ.get('RESTS_LIST_WORKERS', 16))
+    RESTS_LIST_TIMEOUT = int(os.environ.get('RESTS_LIST_TIMEOUT', 60))
+    TICKET_INDEX_TTL = int(os.environ.get('TICKET_INDEX_TTL', 300))
+    TICKET_INDEX_MAX_FILES = int(os.environ.get('TICKET_INDEX_MAX_FILES', 5000))
+    TICKET_INDEX_WORKERS = int(os.environ.get('TICKET_INDEX_WORKERS', 8))
+    TICKET_INDEX_TIMEOUT = int(os.environ.get('TICKET_INDEX_TIMEOUT', 900))
+    TICKET_INDEX_SWEEP_FILES = int(os.environ.get('TICKET_INDEX_SWEEP_FILES', 50000))
+
     MARK_ERRORS_LAST_DAYS = int(os.environ.get('MARK_ERRORS_LAST_DAYS', 7))
     MARK_ERRORS_LAST_UTMS = int(os.environ.get('MARK_ERRORS_LAST_UTMS', 15))
 
@@ -31,12 +71,29 @@ class AppConfig(object):
         'use_unicode': True,
     }
 
+    UKM_POOL_SIZE = int(os.environ.get('UKM_POOL_SIZE', 4))
+    UKM_POOL_IDLE = int(os.environ.get('UKM_POOL_IDLE', 300))
+    UKM_POOL_PING = int(os.environ.get('UKM_POOL_PING', 30))
+    UKM_POOL_WAIT = int(os.environ.get('UKM_POOL_WAIT', 10))
+    UKM_MARKS_CHUNK = int(os.environ.get('UKM_MARKS_CHUNK', 200))
+    UKM_CACHE_SIZE = int(os.environ.get('UKM_CACHE_SIZE', 10000))
+    UKM_CACHE_TTL = int(os.environ.get('UKM_CACHE_TTL', 600))
+    UKM_CACHE_EMPTY_TTL = int(os.environ.get('UKM_CACHE_EMPTY_TTL', 60))
+
     MONGO_CONN = os.environ.get('MONGODB_CONN', 'localhost:27017')
     MONGO_DB = os.environ.get('MONGO_DB', 'utmr')
     MONGO_COL_ERR = os.environ.get('MONGO_COL_ERR', 'marks')
     MONGO_COL_UTM = os.environ.get('MONGO_COL_UTM', 'utm')
     MONGO_COL_RES = os.environ.get('MONGO_COL_RES', 'results')
     MONGO_COL_QUE = os.environ.get('MONGO_COL_QUE', 'queue')
+    # Лимиты одновременных задач по типам: QUEUE_LIMITS=utm_logs=1,service_clean=1,nattn_request=2,
+    # для типа, которого нет в списке, лимит 1
+    QUEUE_LIMITS = {k: int(v) for k, v in (
+        i.split('=') for i in os.environ.get('QUEUE_LIMITS',
+                                             'utm_logs=1,service_clean=1,nattn_request=1,ttn_bulk=1').split(','))}
+    QUEUE_POLL = int(os.environ.get('QUEUE_POLL', 2))
+    QUEUE_HEARTBEAT = int(os.environ.get('QUEUE_HEARTBEAT', 30))
+    QUEUE_STALE = int(os.environ.get('QUEUE_STALE', 300))
 
     MAIL_USER = os.environ.get('MAIL_USER', '')
     MAIL_PASS = os.environ.get('MAIL_PASS', '')
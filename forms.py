@@ -1,5 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, IntegerField, SelectField, BooleanField, DateTimeField
+from flask_wtf.file import FileField
+from wtforms import StringField, IntegerField, SelectField, BooleanField, DateTimeField, TextAreaField
 from wtforms.validators import DataRequired, Length, Regexp
 
 
@@ -25,9 +26,15 @@ class MarkForm(FsrarForm):
     mark = StringField('mark', validators=[DataRequired()])
 
 
+class MarkBulkForm(FsrarForm):
+    marks = TextAreaField('marks')
+    file = FileField('file')
+
+
 class MarkFormError(FsrarForm):
     error = SelectField('error_type', coerce=int)
     mark = StringField('mark')
+    days = IntegerField('days')
 
 
 class TTNForm(FsrarForm):
@@ -43,6 +50,20 @@ class WBRepealConfirmForm(TTNForm):
     is_confirm = SelectField('is_confirm', choices=(('Accepted', 'Подтвердить'), ('Rejected', 'Отклонить')))
 
 
+class TTNBulkForm(FsrarForm):
+    action = SelectField('action', choices=(
+        ('resend', 'Повторный запрос TTN'),
+        ('reject', 'Отклонить/отозвать TTN'),
+        ('repeal_wb', 'Запрос распроведения TTN'),
+        ('repeal_aco', 'Запрос распроведения акта постановки'),
+        ('repeal_awo', 'Запрос распроведения акта списания'),
+        ('confirm_repeal', 'Подтвердить распроведение'),
+        ('reject_repeal', 'Отклонить распроведение'),
+    ))
+    rows = TextAreaField('rows')
+    file = FileField('file')
+
+
 class ChequeForm(FsrarForm):
     kassa = StringField('kassa', validators=[DataRequired(), Length(min=1, max=20, message='от 1 до 20 символов')])
     inn = StringField('inn', validators=[DataRequired(), Length(min=10, max=10, message='10 цифр')])
@@ -1,20 +1,18 @@
 import logging
 import os
-import re
 import smtplib
 from datetime import datetime
 from email.header import Header
 from email.mime.text import MIMEText
 from typing import Optional, Union, List
 
+from pymongo.errors import DuplicateKeyError
+
 from app import Utm
 from config import AppConfig
-
-
-def catch_error_line(line: str, re_err) -> Optional[str]:
-    """ Поиск ошибок в строке и возврат текста ошибки"""
-    error_result = re_err.search(line)
-    return error_result.groups()[0] if error_result else None
+from mark_rollups import ensure_rollup_indexes, rebuild_rollups, rollup_marks
+from transport_log import file_fingerprint, resume_offset, parse_log_for_errors
+from workers import run_bounded
 
 
 def get_marks_from_errors(mark_res: str) -> (str, str):
@@ -25,32 +23,75 @@ def get_marks_from_errors(mark_res: str) -> (str, str):
     return mark, description
 
 
-def parse_log_for_errors(filename: str) -> (list, int, str):
-    """ Возвращаем список событий с ошибками, кол-во чеков в логе"""
-    re_error = re.compile('<error>(.*)</error>')
-    error_mark_events = []
-    cheques_counter = 0
-    err = None
+def claim_log_range(col, key: dict, saved: Optional[dict], fingerprint: dict, end: int, cheques: int) -> bool:
+    """ Атомарный захват разобранной части журнала: позиция сохраняется, только если ее не изменил
+    параллельный разбор того же УТМ тем же читателем с момента чтения saved. False - часть уже захвачена
+    """
+    state = {**key, 'ino': fingerprint['ino'], 'head': fingerprint['head'], 'offset': end,
+             'cheques': cheques, 'date': datetime.now()}
 
-    try:
-        with open(filename, encoding="utf8") as file:
-            cheque_text = 'Получен чек.'
+    if saved is None:
+        col.create_index([('fsrar', 1), ('log', 1), ('reader', 1)], unique=True)
+        try:
+            col.insert_one(state)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    found = {'_id': saved['_id'], 'ino': saved.get('ino'), 'head': saved.get('head'), 'offset': saved.get('offset')}
+    return col.replace_one(found, state).matched_count == 1
 
-            for line in file.readlines():
-                if cheque_text in line:
-                    cheques_counter += 1
 
-                else:
-                    error_text = catch_error_line(line, re_error)
-                    if error_text is not None:
-                        error_time = datetime.strptime(line[0:19], '%Y-%m-%d %H:%M:%S')
-                        error_mark_events.append([error_time, error_text])
+def parse_log_incremental(utm: Utm, filename: str, reader: str,
+                          history: bool = False) -> (list, list, int, Optional[str]):
+    """ Разбор только дописанной части журнала с прошлого запуска
+    Позиция и отпечаток журнала хранятся в MongoDB (log_offsets) отдельно для каждого читателя (cron, web, job),
+    при ротации или обрезке журнала выполняется полный разбор. Разобранная часть захватывается атомарно
+    (claim_log_range): если тот же журнал одновременно разобрал другой запуск, его события не повторяются.
+    С history события журнала копятся в log_errors по одному документу на событие и удаляются при ротации,
+    без history все события - это новые события.
+    Возвращаем новые события, все события журнала, всего чеков, ошибку
+    """
+    from app import mongo
 
-    except (FileNotFoundError, TypeError):
+    key = {'fsrar': utm.fsrar, 'log': os.path.basename(filename), 'reader': reader}
+
+    try:
+        fingerprint = file_fingerprint(filename)
+    except (OSError, TypeError):
         err = 'Недоступен или журнал не найден'
         logging.error(f'{err} {filename}')
+        return [], [], 0, err
+
+    saved = mongo.db.log_offsets.find_one(key)
+    state = saved
+    offset = resume_offset(state, fingerprint)
+    # В прежнем формате события хранились в самом состоянии, такой журнал разбираем заново
+    if offset == 0 or 'errors' in state:
+        offset, state = 0, None
+
+    new_events, cheques, err, end = parse_log_for_errors(filename, offset)
+    if err is not None:
+        return [], [], 0, err
+
+    cheques += state['cheques'] if state else 0
+
+    if not claim_log_range(mongo.db.log_offsets, key, saved, fingerprint, end, cheques):
+        logging.info(f'Журнал {utm.fsrar} {reader} уже разобран параллельным запуском')
+        current = mongo.db.log_offsets.find_one(key) or {}
+        new_events, cheques = [], current.get('cheques', 0)
+    elif history:
+        if state is None:
+            mongo.db.log_errors.create_index([('fsrar', 1), ('log', 1), ('reader', 1)])
+            mongo.db.log_errors.delete_many(key)
+        if new_events:
+            mongo.db.log_errors.insert_many([{**key, 'date': dt, 'message': message} for dt, message in new_events])
 
-    return error_mark_events, cheques_counter, err
+    events = new_events
+    if history:
+        events = [[e['date'], e['message']] for e in mongo.db.log_errors.find(key).sort('_id', 1)]
+
+    return new_events, events, cheques, None
 
 
 def parse_errors(errors: list, utm: Utm) -> List[dict]:
@@ -64,8 +105,7 @@ def parse_errors(errors: list, utm: Utm) -> List[dict]:
 
         elif isinstance(err_marks, list):
             for m in err_marks:
-                template_result['mark'] = m
-                lst.append(template_result)
+                lst.append({**template_result, 'mark': m})
 
         else:
             template_result['mark'] = err_marks
@@ -134,6 +174,33 @@ def send_email(subject: str, text: str, mail_from: Union[str, list], mail_to: st
         logging.error(f'Ошибка отправки email {AppConfig.MAIL_USER}@{AppConfig.MAIL_HOST}:{AppConfig.MAIL_PASS}')
 
 
+def mark_key(e: dict) -> tuple:
+    """ Ключ уникальности ошибки в пределах УТМ """
+    return e['date'], e.get('mark'), e['error']
+
+
+def filter_new_marks(col, errors: List[dict]) -> List[dict]:
+    """ Отбор еще не сохраненных ошибок одним запросом к MongoDB на весь список ошибок УТМ """
+    if not errors:
+        return []
+
+    dates = [e['date'] for e in errors]
+    saved = col.find(
+        {'fsrar': errors[0]['fsrar'], 'date': {'$gte': min(dates), '$lte': max(dates)}},
+        {'_id': 0, 'date': 1, 'mark': 1, 'error': 1},
+    )
+    seen = {mark_key(e) for e in saved}
+    marks = []
+
+    for e in errors:
+        key = mark_key(e)
+        if key not in seen:
+            seen.add(key)
+            marks.append(e)
+
+    return marks
+
+
 def process_transport_transaction_log(u: Utm, file: str):
     """ Сохранение ошибок из файла журнала транзакций УТМ в MongoDB и отправка писем """
     file = get_log_file(u, file)
@@ -141,16 +208,13 @@ def process_transport_transaction_log(u: Utm, file: str):
     if file is not None:
         from app import mongo
 
-        errors_found, _, _ = parse_log_for_errors(file)
+        errors_found, _, _, _ = parse_log_incremental(u, file, 'cron')
         errors = parse_errors(errors_found, u)
-        marks = []
-
-        for e in errors:
-            if not mongo.db.marks.find_one({'date': e['date'], 'fsrar': e['fsrar']}):
-                marks.append(e)
+        marks = filter_new_marks(mongo.db.marks, errors)
 
         if marks:
             mongo.db.marks.insert_many(marks)
+            rollup_marks(mongo.db.marks_daily, marks)
 
             human_date = '%Y.%m.%d %H:%M'
             message = '\n\n'.join([f"{e.get('date').strftime(human_date)} Ошибка {e.get('error')}\n"
@@ -168,9 +232,23 @@ def process_utm(u: Utm):
 
 
 def main():
+    from app import mongo
+
     start = datetime.now()
-    [process_utm(u) for u in Utm.get_active()]
+    mongo.db.marks.create_index([('fsrar', 1), ('date', 1)])
+    ensure_rollup_indexes(mongo.db.marks_daily)
+    # Первый запуск после появления итогов: заполняем их по уже сохраненным ошибкам
+    if mongo.db.marks_daily.estimated_document_count() == 0:
+        logging.info(f'Marks rollups built: {rebuild_rollups(mongo.db.marks, mongo.db.marks_daily)} rows')
+    utms = Utm.get_active()
+    results = run_bounded(process_utm, utms, AppConfig.UTM_LOG_WORKERS, AppConfig.UTM_LOG_TIMEOUT)
+
+    for u, (_, e) in zip(utms, results):
+        if e is not None:
+            logging.error(f'УТМ {u.host} {u.title} {u.fsrar} не обработан: {e}')
+
     logging.info(f'Cheque errors processing done: {datetime.now() - start}')
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -1,108 +1,93 @@
 import logging
-from collections import OrderedDict
-from datetime import datetime, timedelta
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from os import listdir, path, environ
 from re import compile
 
 from pymongo import MongoClient
-from xmltodict import parse
 
 from app import Utm
+from config import AppConfig
+from rests import ensure_rests_indexes, parse_rests_file, rests_kind, write_rests
+from workers import run_bounded
 
 
-def humanize_date(iso_date: str) -> str:
+def list_rests_files(u: Utm, valid_filename) -> list:
+    """ Файлы ReplyRests в каталоге обмена УТМ """
+    logging.info(f'ReplyRests Processing UTM: {u} {u.host}')
     try:
-        iso_date = datetime.strptime(iso_date, '%Y-%m-%dT%H:%M:%S.%f')
-    except ValueError:
-        iso_date = datetime.strptime(iso_date, '%Y-%m-%dT%H:%M:%S')
+        files = [f for f in listdir(u.path) if valid_filename.match(f)]
+    except Exception as e:
+        logging.error(f'ReplyRests CANT FIND DIR {e}')
+        files = []
 
-    return iso_date + timedelta(hours=7)
-
-
-def add_code_to_rests(pos, rst):
-    if isinstance(pos, str):
-        logging.error(f'ReplyRests POS IS STR {pos}')
-    else:
-        alc_code = pos.get('rst:Product').get('pref:AlcCode')
-        quantity = pos.get('rst:Quantity')
-        rst[alc_code] = float(quantity)
+    return files
 
 
 def main():
     start = datetime.now()
     mongo = MongoClient()
+    col = mongo.utmr.rests
+    ensure_rests_indexes(col)
     valid_regexp = environ.get('RESTS_REGEXP', f'({datetime.now().strftime("%y%m%d")}).*(ReplyRests)')
     valid_filename = compile(valid_regexp)
     logging.info(f'ReplyRests Processing files with REGEXP: {valid_regexp}')
 
-    results = []
+    # Собираем файлы всех УТМ, уже загруженные ранее пропускаем без разбора
+    utms = Utm.get_active()
+    tasks = []
+    listed = run_bounded(lambda x: list_rests_files(x, valid_filename), utms,
+                         AppConfig.RESTS_LIST_WORKERS, AppConfig.RESTS_LIST_TIMEOUT)
+    for u, (files, e) in zip(utms, listed):
+        if e is not None:
+            logging.error(f'ReplyRests {u} {u.path} не прочитан каталог: {e}')
+            continue
+        loaded = {d['file'] for d in col.find({'fsrar': u.fsrar, 'file': {'$in': files}}, {'file': 1})}
 
-    for u in Utm.get_active():
-        print(u.host, u)
-        logging.info(f'ReplyRests Processing UTM: {u} {u.host}')
+        for reply_rests in files:
+            is_retail = rests_kind(reply_rests)
+            if is_retail is None:
+                logging.error(f'ReplyRests unexpected filename {reply_rests}')
+            elif reply_rests not in loaded:
+                tasks.append((u, is_retail, reply_rests))
+
+    logging.info(f'ReplyRests to process: {len(tasks)} files')
+
+    # Разбор XML занимает процессор, поэтому выполняется в пуле процессов
+    parsed = defaultdict(list)
+    total_size, parse_time = 0, 0.0
+    with ProcessPoolExecutor(max_workers=AppConfig.RESTS_WORKERS) as executor:
+        filenames = [path.join(u.path, reply_rests) for u, _, reply_rests in tasks]
+
+        for (u, is_retail, reply_rests), result in zip(tasks, executor.map(parse_rests_file, filenames)):
+            rests_date, rests, seconds, size, err = result
+            total_size += size
+            parse_time += seconds
+
+            if err is not None:
+                logging.error(f'ReplyRests SKIPPED {reply_rests} {err}')
+            elif rests_date is None:
+                logging.warning(f'ReplyRests {u.host} {reply_rests} without RestsDate')
+            else:
+                logging.info(f'ReplyRests parsed {reply_rests}: {len(rests)} codes, '
+                             f'{size / 1024 / 1024:.1f} MB in {seconds:.2f} s')
+                parsed[(u.fsrar, is_retail)].append((rests_date, rests, reply_rests))
+
+    inserted = 0
+    for (fsrar, is_retail), items in parsed.items():
         try:
-            files = [f for f in listdir(u.path) if valid_filename.match(f)]
+            inserted += write_rests(col, fsrar, is_retail, items, AppConfig.RESTS_KEYFRAME_DAYS)
         except Exception as e:
-            logging.error(f'ReplyRests CANT FIND DIR {e}')
-            files = []
-        # legacy, in case we need error subdir too
-        # for _, _, files in walk('.'):
-        #     files = [fi for fi in files if valid_filename.match(fi)]
-        #     files.sort(reverse=True)
+            logging.error(f'ReplyRests NOT SAVED {fsrar} {is_retail} {e}')
 
-        logging.info(f'ReplyRests to process: {files}')
+    elapsed = (datetime.now() - start).total_seconds()
+    summary = (f'ReplyRests Done in {elapsed:.1f} s: files {len(tasks)}, saved {inserted}, '
+               f'{total_size / 1024 / 1024:.1f} MB, parse time {parse_time:.1f} s, '
+               f'{total_size / 1024 / 1024 / max(elapsed, 0.001):.1f} MB/s, {len(tasks) / max(elapsed, 0.001):.1f} files/s')
+    logging.info(summary)
+    print(summary)
 
-        for reply_rests in files:
-            logging.info(f'ReplyRests processing: {reply_rests}')
-            print('.', end='')
-            res = dict()
-            if 'ReplyRestsShop' in reply_rests:
-                is_retail = True
-                rests_name = 'ns:ReplyRestsShop_v2'
-                position_name = 'rst:ShopPosition'
-
-            elif 'ReplyRests' in reply_rests:
-                is_retail = False
-                rests_name = 'ns:ReplyRests_v2'
-                position_name = 'rst:StockPosition'
 
-            else:
-                raise Exception(f'Unexpected filename {reply_rests}')
-            
-            with open(path.join(u.path, reply_rests), encoding="utf8") as f:
-                try:
-
-                    rests_dict = parse(f.read())
-                    document = rests_dict.get('ns:Documents').get('ns:Document')
-                    doc_rests = document.get(rests_name)
-                    rests_date = humanize_date(doc_rests.get('rst:RestsDate'))
-                    doc_products = doc_rests.get('rst:Products')
-
-                    del rests_dict
-                    del doc_rests
-                    del document
-
-                    if isinstance(doc_products, OrderedDict):
-                        rests = dict()
-                        for position in doc_products.get(position_name):
-                            add_code_to_rests(position, rests)
-                    else:
-                        logging.warning(f'ReplyRests {u.host} {reply_rests} not a dict')
-
-                    res['date'] = rests_date
-                    res['fsrar'] = u.fsrar
-                    res['is_retail'] = is_retail
-                    res['rests'] = rests
-
-                    if not mongo.utmr.rests.find_one({'fsrar': res['fsrar'], 'date': res['date'], 'is_retail': res['is_retail']}):
-                        mongo.utmr.rests.insert_one(res)
-                        del res
-                
-                except Exception as e:
-                    logging.error(f'ReplyRests SKIPPED {reply_rests} {e}')
-        print(' ')
-
-    logging.info(f'ReplyRests Done in {datetime.now() - start}')
-
-
-main()
+if __name__ == '__main__':
+    main()
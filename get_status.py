@@ -1,9 +1,79 @@
-from time import sleep
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, Tuple
 
-from app import Utm, Result
-from utils import parse_utm
+from app import Utm, Result, mongo
+from config import AppConfig
+from poll_scheduler import PollScheduler
+from status_store import ensure_status_indexes
+from utils import CERT_FIELDS, is_offline, parse_utm
 
-while True:
-    results = [parse_utm(utm) for utm in Utm.get_active()]
-    Result.save_many(results)
-    sleep(60)
+
+def main():
+    """ Опрос УТМ по расписанию
+    Опросы выполняются в пуле потоков и не ждут друг друга: результат записывается по мере готовности,
+    поэтому медленный или зависший УТМ не задерживает опрос остальных. Между опросами ждем ближайший
+    по расписанию, но не дольше STATUS_TICK, чтобы вовремя забирать внеочередные запросы
+    """
+    ensure_status_indexes(mongo.db.status, mongo.db.status_changes)
+    scheduler = PollScheduler(AppConfig.STATUS_INTERVAL, AppConfig.STATUS_CERT_INTERVAL, AppConfig.STATUS_MAX_BACKOFF)
+    executor = ThreadPoolExecutor(max_workers=AppConfig.UTM_POLL_WORKERS)
+    running: Dict[Future, Tuple[Utm, bool]] = {}
+    polled = with_cert_count = offline = 0
+    last_save = last_requests = 0
+
+    while True:
+        now = time.monotonic()
+        utms = {u.fsrar: u for u in Utm.get_active()}
+        scheduler.sync(utms, now)
+        if now - last_requests >= AppConfig.STATUS_TICK:
+            for fsrar in Result.take_poll_requests():
+                scheduler.force(fsrar, now)
+            last_requests = now
+
+        for fsrar, with_cert in scheduler.due(now):
+            running[executor.submit(parse_utm, utms[fsrar], with_cert)] = (utms[fsrar], with_cert)
+
+        next_due = scheduler.next_due()
+        timeout = AppConfig.STATUS_TICK if next_due is None else min(max(next_due - now, 0), AppConfig.STATUS_TICK)
+        if running:
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+        else:
+            done = set()
+            time.sleep(timeout)
+
+        now = time.monotonic()
+        for future in done:
+            u, with_cert = running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.exception(f'Status {u.fsrar} {u.host}: {e}')
+                result = Result(u)
+                result.error = f'Ошибка опроса {e}'
+
+            ok = not is_offline(result)
+            offline += not ok
+            polled += 1
+            with_cert_count += with_cert
+
+            # Сертификат не запрашивался или не получен, оставляем сведения с прошлого опроса
+            previous = scheduler.result(u.fsrar)
+            if previous is not None and not (with_cert and ok):
+                for field in CERT_FIELDS:
+                    setattr(result, field, getattr(previous, field))
+
+            scheduler.record(u.fsrar, result, with_cert, ok, now)
+
+        # Готовые результаты сохраняются вместе, не чаще раза в STATUS_TICK, если еще идут опросы
+        if polled and (not running or now - last_save >= AppConfig.STATUS_TICK):
+            changed = Result.save_many(scheduler.results(), utms)
+            logging.info(f'Status: опрошено {polled}, с сертификатом {with_cert_count}, '
+                         f'недоступны {offline}, изменений {changed}, опрашиваются {len(running)}')
+            polled = with_cert_count = offline = 0
+            last_save = now
+
+
+if __name__ == '__main__':
+    main()
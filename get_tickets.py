@@ -0,0 +1,38 @@
+import logging
+from datetime import datetime
+
+from app import Utm, mongo
+from config import AppConfig
+from tickets import ensure_ticket_indexes, update_ticket_index
+from workers import run_bounded
+
+
+def index_utm(u: Utm) -> (int, int, int):
+    """ Обновление индекса квитанций одного УТМ, не больше TICKET_INDEX_SWEEP_FILES файлов за запуск,
+    чтобы первое построение большого каталога укладывалось в TICKET_INDEX_TIMEOUT и дочитывалось следующими запусками.
+    Время обновления сохраняется, только когда индекс дочитан
+    """
+    updated, removed, pending = update_ticket_index(mongo.db.tickets, u.fsrar, u.path,
+                                                    AppConfig.TICKET_INDEX_SWEEP_FILES)
+    if not pending:
+        mongo.db.ticket_scans.replace_one({'fsrar': u.fsrar}, {'fsrar': u.fsrar, 'date': datetime.now()}, upsert=True)
+    return updated, removed, pending
+
+
+def main():
+    start = datetime.now()
+    ensure_ticket_indexes(mongo.db.tickets)
+    utms = Utm.get_active()
+    results = run_bounded(index_utm, utms, AppConfig.TICKET_INDEX_WORKERS, AppConfig.TICKET_INDEX_TIMEOUT)
+
+    for u, (counts, e) in zip(utms, results):
+        if e is not None:
+            logging.error(f'Ticket index {u} {u.path} не обновлен: {e}')
+        else:
+            logging.info(f'Ticket index {u}: обновлено {counts[0]}, удалено {counts[1]}, осталось {counts[2]}')
+
+    logging.info(f'Ticket index done in {datetime.now() - start}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import logging
+import os
+import socket
+import threading
+from time import sleep
+from typing import List, Tuple
+
+from app import Utm, mongo, clean_utm, request_nattn, scan_utm_log, send_ttn_row, wait_ttn_slot
+from config import AppConfig
+from jobs import JobQueue
+from workers import run_bounded
+
+
+def active_utms(params: dict) -> List[Tuple[dict, Utm]]:
+    """ Все активные УТМ """
+    return [({'fsrar': u.fsrar, 'title': u.title}, u) for u in Utm.get_active()]
+
+
+def ttn_rows(params: dict) -> List[Tuple[dict, dict]]:
+    """ Строки пакетной отправки TTN из параметров задачи """
+    items = []
+    for row in params['rows']:
+        utm = Utm.get_one(fsrar=row['fsrar']) if row['fsrar'] else None
+        info = {'fsrar': row['fsrar'], 'title': utm.title if utm is not None else '',
+                'wbregid': row['wbregid'], 'action': row['action']}
+        items.append((info, row))
+    return items
+
+
+# Тип задачи: элементы задачи (сведения для отчета, элемент), обработка одного элемента, кол-во потоков,
+# ограничение времени на один элемент, ожидание перед обработкой элемента, которое не входит в это время
+JOB_TYPES = {
+    'service_clean': (active_utms, clean_utm, AppConfig.UTM_CLEAN_WORKERS, AppConfig.UTM_CLEAN_TIMEOUT, None),
+    'utm_logs': (active_utms, lambda u: scan_utm_log(u, False, 'job'), AppConfig.UTM_LOG_WORKERS,
+                 AppConfig.UTM_LOG_TIMEOUT, None),
+    'nattn_request': (active_utms, request_nattn, AppConfig.UTM_POLL_WORKERS, AppConfig.UTM_READ_TIMEOUT * 2, None),
+    'ttn_bulk': (ttn_rows, send_ttn_row, AppConfig.TTN_BULK_WORKERS, AppConfig.TTN_BULK_TIMEOUT, wait_ttn_slot),
+}
+
+
+def run_job(queue: JobQueue, job: dict, worker: str):
+    """ Выполнение задачи по ее элементам, результат каждого элемента сразу пишется в задачу """
+    get_items, func, workers, timeout, before = JOB_TYPES[job['type']]
+    items = get_items(job['params'])
+    queue.set_total(job['_id'], len(items))
+
+    def progress(i: int, result, error):
+        queue.progress(job['_id'], i, {**items[i][0], 'result': result if error is None else f'ошибка {error}'})
+
+    # Пока все УТМ заняты долгой обработкой, прогресс не обновляется, поэтому отмечаемся отдельно
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(AppConfig.QUEUE_HEARTBEAT):
+            queue.heartbeat(job['_id'])
+            queue.worker_alive(worker)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        run_bounded(func, [item for _, item in items], workers, timeout, progress, before)
+    finally:
+        stop.set()
+
+
+def main():
+    queue = JobQueue(mongo.db[AppConfig.MONGO_COL_QUE])
+    queue.ensure_indexes()
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    # Тип, не указанный в QUEUE_LIMITS, выполняется по одной задаче, а не остается в очереди навсегда
+    limits = {job_type: AppConfig.QUEUE_LIMITS.get(job_type, 1) for job_type in JOB_TYPES}
+    logging.info(f'Job worker {worker} started, limits {limits}')
+
+    while True:
+        queue.worker_alive(worker)
+        stale = queue.fail_stale(AppConfig.QUEUE_STALE)
+        if stale:
+            logging.warning(f'Jobs without heartbeat marked as failed: {stale}')
+
+        job = queue.claim(limits, worker)
+        if job is None:
+            sleep(AppConfig.QUEUE_POLL)
+            continue
+
+        logging.info(f'Job {job["_id"]} {job["type"]} started')
+        try:
+            run_job(queue, job, worker)
+            queue.finish(job['_id'])
+            logging.info(f'Job {job["_id"]} {job["type"]} done')
+        except Exception as e:
+            logging.exception(f'Job {job["_id"]} {job["type"]} failed')
+            queue.finish(job['_id'], str(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import json
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+
+def job_key(job_type: str, params: dict) -> str:
+    """ Ключ для поиска одинаковых задач: тип и параметры """
+    return f'{job_type}:{json.dumps(params, sort_keys=True, default=str)}'
+
+
+class JobQueue(object):
+    """ Очередь фоновых задач в MongoDB
+    Веб-приложение ставит задачу в очередь, job_worker.py забирает и выполняет ее в отдельном процессе.
+    Прогресс пишется в документ задачи, результат каждого элемента - отдельным документом в <col>_results,
+    чтобы размер задачи не зависел от кол-ва и объема результатов. Обработчики отмечаются в <col>_workers.
+    Одинаковая задача, которая еще не завершена, повторно не ставится: уникальный индекс по key
+    действует только для документов с inflight.
+    """
+
+    def __init__(self, col):
+        self.col = col
+        self.results = col.database[f'{col.name}_results']
+        self.workers = col.database[f'{col.name}_workers']
+        self._indexed = False
+
+    def ensure_indexes(self):
+        if self._indexed:
+            return
+
+        self.col.create_index([('key', ASCENDING)], unique=True, partialFilterExpression={'inflight': True})
+        self.col.create_index([('type', ASCENDING), ('state', ASCENDING), ('created', ASCENDING)])
+        self.results.create_index([('job_id', ASCENDING), ('index', ASCENDING)])
+        self._indexed = True
+
+    def enqueue(self, job_type: str, title: str, params: Optional[dict] = None) -> ObjectId:
+        """ Постановка задачи в очередь, если такая же задача уже ждет или выполняется, возвращаем ее """
+        self.ensure_indexes()
+        params = params or {}
+        key = job_key(job_type, params)
+
+        try:
+            return self.col.insert_one({
+                'type': job_type,
+                'title': title,
+                'key': key,
+                'params': params,
+                'state': QUEUED,
+                'inflight': True,
+                'total': 0,
+                'done': 0,
+                'error': None,
+                'created': datetime.now(),
+            }).inserted_id
+        except DuplicateKeyError:
+            job = self.col.find_one({'key': key, 'inflight': True}, {'_id': 1})
+            if job is None:
+                # задача завершилась между вставкой и поиском
+                return self.enqueue(job_type, title, params)
+            return job['_id']
+
+    def claim(self, limits: Dict[str, int], worker: str) -> Optional[dict]:
+        """ Забрать самую старую ожидающую задачу того типа, у которого не превышен лимит одновременных задач
+        Лимит проверяется после захвата: если другой обработчик успел занять последнее место, задача возвращается в очередь
+        """
+        for job_type, limit in limits.items():
+            if self.col.count_documents({'type': job_type, 'state': RUNNING}) >= limit:
+                continue
+
+            now = datetime.now()
+            job = self.col.find_one_and_update(
+                {'type': job_type, 'state': QUEUED},
+                {'$set': {'state': RUNNING, 'worker': worker, 'started': now, 'heartbeat': now}},
+                sort=[('created', ASCENDING)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if job is None:
+                continue
+
+            if self.col.count_documents({'type': job_type, 'state': RUNNING}) > limit:
+                self.col.update_one({'_id': job['_id'], 'state': RUNNING},
+                                    {'$set': {'state': QUEUED}, '$unset': {'worker': '', 'started': '', 'heartbeat': ''}})
+                continue
+
+            return job
+
+        return None
+
+    def set_total(self, job_id: ObjectId, total: int):
+        self.col.update_one({'_id': job_id}, {'$set': {'total': total, 'heartbeat': datetime.now()}})
+
+    def progress(self, job_id: ObjectId, index: int, result: dict):
+        """ Результат элемента задачи, index - номер элемента (УТМ в справочнике, строка), по нему сортируется get """
+        self.results.insert_one({**result, 'job_id': job_id, 'index': index})
+        self.col.update_one({'_id': job_id}, {'$inc': {'done': 1}, '$set': {'heartbeat': datetime.now()}})
+
+    def heartbeat(self, job_id: ObjectId):
+        self.col.update_one({'_id': job_id}, {'$set': {'heartbeat': datetime.now()}})
+
+    def finish(self, job_id: ObjectId, error: Optional[str] = None):
+        self.col.update_one({'_id': job_id}, {
+            '$set': {'state': DONE if error is None else FAILED, 'error': error, 'finished': datetime.now()},
+            '$unset': {'inflight': ''},
+        })
+
+    def fail_stale(self, max_age: int) -> int:
+        """ Задачи, обработчик которых перестал отвечать, завершаются с ошибкой, чтобы их можно было поставить заново """
+        result = self.col.update_many(
+            {'state': RUNNING, 'heartbeat': {'$lt': datetime.now() - timedelta(seconds=max_age)}},
+            {'$set': {'state': FAILED, 'error': 'Обработчик задачи не отвечает', 'finished': datetime.now()},
+             '$unset': {'inflight': ''}},
+        )
+        return result.modified_count
+
+    def worker_alive(self, worker: str):
+        """ Отметка обработчика, вызывается в цикле обработчика и во время выполнения задачи """
+        self.workers.replace_one({'_id': worker}, {'_id': worker, 'date': datetime.now()}, upsert=True)
+
+    def workers_alive(self, max_age: int) -> int:
+        """ Кол-во обработчиков, отмечавшихся за последние max_age секунд """
+        return self.workers.count_documents({'date': {'$gte': datetime.now() - timedelta(seconds=max_age)}})
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """ Задача с результатами элементов в порядке элементов, а не завершения """
+        try:
+            job = self.col.find_one({'_id': ObjectId(job_id)})
+        except (InvalidId, TypeError):
+            return None
+
+        if job is not None:
+            job['results'] = list(self.results.find({'job_id': job['_id']}, {'_id': 0, 'job_id': 0, 'index': 0})
+                                  .sort('index', ASCENDING))
+        return job
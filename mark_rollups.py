@@ -0,0 +1,95 @@
+import argparse
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+from bson.son import SON
+from pymongo import ASCENDING, UpdateOne
+
+
+def ensure_rollup_indexes(col):
+    col.create_index([('day', ASCENDING), ('error', ASCENDING), ('fsrar', ASCENDING)], unique=True)
+
+
+def day_start(date: datetime) -> datetime:
+    return datetime(date.year, date.month, date.day)
+
+
+def rollup_marks(col, marks: Iterable[dict]) -> int:
+    """ Добавление новых ошибок в дневные итоги (день, тип ошибки, УТМ) через $inc,
+    вызывается после вставки тех же ошибок в marks. Возвращаем кол-во затронутых итогов
+    """
+    counts = Counter()
+    titles = {}
+    for m in marks:
+        key = (day_start(m['date']), m['error'], m['fsrar'])
+        counts[key] += 1
+        titles[key] = m.get('title')
+
+    ops: List[UpdateOne] = [
+        UpdateOne({'day': day, 'error': error, 'fsrar': fsrar},
+                  {'$inc': {'count': count}, '$set': {'title': titles[day, error, fsrar]}}, upsert=True)
+        for (day, error, fsrar), count in counts.items()
+    ]
+    if ops:
+        col.bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def rebuild_rollups(marks, col, since: Optional[datetime] = None) -> int:
+    """ Пересчет дневных итогов по marks с начала дня since (или целиком), для первого заполнения
+    и исправления расхождений. Запускать, когда get_logs не работает, иначе его $inc могут потеряться
+    """
+    match = {'date': {'$gte': day_start(since)}} if since else {}
+    pipeline = [
+        {'$match': match},
+        {'$group': {
+            '_id': {
+                'day': {'$dateFromParts': {
+                    'year': {'$year': '$date'}, 'month': {'$month': '$date'}, 'day': {'$dayOfMonth': '$date'},
+                }},
+                'error': '$error',
+                'fsrar': '$fsrar',
+            },
+            'title': {'$last': '$title'},
+            'count': {'$sum': 1},
+        }},
+    ]
+    docs = [{**d['_id'], 'title': d['title'], 'count': d['count']}
+            for d in marks.aggregate(pipeline, allowDiskUse=True)]
+
+    col.delete_many({'day': {'$gte': day_start(since)}} if since else {})
+    if docs:
+        col.insert_many(docs)
+    return len(docs)
+
+
+def rollup_totals(col, field: str, start_date: datetime, limit: Optional[int] = None) -> List[dict]:
+    """ Итоги ошибок по полю (error, title) с начала дня start_date, в том же виде, что $group по marks """
+    pipeline = [
+        {'$match': {'day': {'$gte': day_start(start_date)}}},
+        {'$group': {'_id': {field: f'${field}'}, 'count': {'$sum': '$count'}}},
+        {'$sort': SON([('count', -1), ('_id', -1)])},
+    ]
+    if limit:
+        pipeline.append({'$limit': limit})
+    return list(col.aggregate(pipeline))
+
+
+def main():
+    from app import mongo
+
+    parser = argparse.ArgumentParser(description='Пересчет дневных итогов ошибок marks_daily по marks')
+    parser.add_argument('--days', type=int, help='пересчитать только последние N дней, по умолчанию все')
+    args = parser.parse_args()
+
+    start = datetime.now()
+    since = start - timedelta(days=args.days) if args.days else None
+    ensure_rollup_indexes(mongo.db.marks_daily)
+    count = rebuild_rollups(mongo.db.marks, mongo.db.marks_daily, since)
+    logging.info(f'Marks rollups rebuilt: {count} rows, {datetime.now() - start}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class PollScheduler(object):
+    """ Расписание опроса УТМ
+    Для каждого УТМ хранится время следующего опроса главной страницы и страницы сертификата.
+    Доступные УТМ опрашиваются раз в interval секунд, после каждой неудачи подряд интервал удваивается
+    до max_backoff, сертификат запрашивается не чаще раза в cert_interval секунд вместе с главной страницей.
+    УТМ, выданный due(), считается опрашиваемым и не выдается повторно до record().
+    Время - значения time.monotonic()
+    """
+
+    def __init__(self, interval: float, cert_interval: float, max_backoff: float):
+        self.interval = interval
+        self.cert_interval = cert_interval
+        self.max_backoff = max_backoff
+        self._state: Dict[str, dict] = {}
+
+    def sync(self, fsrars: Iterable[str], now: float):
+        """ Новые УТМ опрашиваются сразу, исключенные из справочника забываются """
+        fsrars = set(fsrars)
+        for fsrar in fsrars - set(self._state):
+            self._state[fsrar] = {'home': now, 'cert': now, 'failures': 0, 'result': None, 'running': False}
+        for fsrar in set(self._state) - fsrars:
+            del self._state[fsrar]
+
+    def force(self, fsrar: str, now: float):
+        """ Внеочередной опрос главной страницы и сертификата """
+        state = self._state.get(fsrar)
+        if state is not None:
+            state['home'] = state['cert'] = now
+            state['failures'] = 0
+
+    def due(self, now: float) -> List[Tuple[str, bool]]:
+        """ УТМ, которые пора опросить, и нужно ли запросить сертификат; выданные УТМ отмечаются как опрашиваемые """
+        due = [(fsrar, s['cert'] <= now) for fsrar, s in self._state.items() if s['home'] <= now and not s['running']]
+        for fsrar, _ in due:
+            self._state[fsrar]['running'] = True
+        return due
+
+    def backoff(self, failures: int) -> float:
+        return min(self.interval * 2 ** failures, self.max_backoff)
+
+    def record(self, fsrar: str, result, with_cert: bool, ok: bool, now: float):
+        """ Результат опроса и время следующего: по интервалу для доступного УТМ, с отсрочкой для недоступного """
+        state = self._state.get(fsrar)
+        if state is None:
+            return
+
+        if ok:
+            state['failures'] = 0
+            state['home'] = now + self.interval
+            if with_cert:
+                state['cert'] = now + self.cert_interval
+        else:
+            state['failures'] += 1
+            state['home'] = now + self.backoff(state['failures'])
+
+        state['result'] = result
+        state['running'] = False
+
+    def result(self, fsrar: str):
+        state = self._state.get(fsrar)
+        return state['result'] if state is not None else None
+
+    def results(self) -> list:
+        return [s['result'] for s in self._state.values() if s['result'] is not None]
+
+    def next_due(self) -> Optional[float]:
+        """ Время ближайшего опроса среди УТМ, которые сейчас не опрашиваются """
+        return min((s['home'] for s in self._state.values() if not s['running']), default=None)
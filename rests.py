@@ -0,0 +1,310 @@
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import OperationFailure
+
+POSITION_TAGS = ('StockPosition', 'ShopPosition')
+
+
+def humanize_date(iso_date: str) -> datetime:
+    try:
+        iso_date = datetime.strptime(iso_date, '%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        iso_date = datetime.strptime(iso_date, '%Y-%m-%dT%H:%M:%S')
+
+    return iso_date + timedelta(hours=7)
+
+
+def local_tag(tag: str) -> str:
+    """ Имя тега без пространства имен {uri} """
+    return tag.rsplit('}', 1)[-1]
+
+
+def rests_kind(filename: str) -> Optional[bool]:
+    """ Признак розничного регистра (Р2) по имени файла, None для прочих файлов """
+    if 'ReplyRestsShop' in filename:
+        return True
+
+    if 'ReplyRests' in filename:
+        return False
+
+    return None
+
+
+class RestsParser(object):
+    """ Потоковый разбор ReplyRests_v2 / ReplyRestsShop_v2
+    Итерация возвращает пары (алкокод, количество), дата остатков доступна в rests_date после ее тега.
+    Разобранные позиции сразу удаляются из дерева, поэтому память ограничена одной позицией.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.rests_date: Optional[datetime] = None
+
+    def __iter__(self) -> Iterator[Tuple[str, float]]:
+        products = None
+
+        for event, elem in ET.iterparse(self.source, events=('start', 'end')):
+            tag = local_tag(elem.tag)
+
+            if event == 'start':
+                if tag == 'Products':
+                    products = elem
+                continue
+
+            if tag == 'RestsDate':
+                self.rests_date = humanize_date(elem.text.strip())
+
+            elif tag in POSITION_TAGS:
+                position = self._position(elem)
+                if position is not None:
+                    yield position
+
+                elem.clear()
+                if products is not None:
+                    products.remove(elem)
+
+    @staticmethod
+    def _position(elem) -> Optional[Tuple[str, float]]:
+        alc_code, quantity = None, None
+
+        for child in elem.iter():
+            tag = local_tag(child.tag)
+            if tag == 'AlcCode':
+                alc_code = child.text
+            elif tag == 'Quantity' and quantity is None:
+                quantity = child.text
+
+        if alc_code is None or quantity is None:
+            logging.error('ReplyRests position without AlcCode or Quantity')
+            return None
+
+        return alc_code.strip(), float(quantity)
+
+
+def read_rests(filename: str) -> (Optional[datetime], dict):
+    """ Дата и остатки {алкокод: количество} из файла ReplyRests """
+    with open(filename, 'rb') as f:
+        parser = RestsParser(f)
+        rests = dict(parser)
+
+    return parser.rests_date, rests
+
+
+def parse_rests_file(filename: str) -> (Optional[datetime], dict, float, int, Optional[str]):
+    """ Разбор файла для пула процессов: дата, остатки, время разбора, размер файла, ошибка """
+    start = time.perf_counter()
+    try:
+        rests_date, rests = read_rests(filename)
+        return rests_date, rests, time.perf_counter() - start, os.path.getsize(filename), None
+    except Exception as e:
+        return None, {}, time.perf_counter() - start, 0, str(e)
+
+
+def apply_changes(state: dict, changes: dict):
+    """ Применение изменений к остаткам, None означает, что алкокода больше нет в остатках """
+    for code, quantity in changes.items():
+        if quantity is None:
+            state.pop(code, None)
+        else:
+            state[code] = quantity
+
+
+def replay_rests(documents: Iterable[dict]) -> Iterator[Tuple[dict, dict]]:
+    """ Восстановление остатков по опорным снимкам (поле rests) и изменениям (поле changes)
+    Документы должны идти по дате, начиная с опорного снимка. Возвращает пары (документ, остатки на его дату)
+    """
+    state = {}
+    for doc in documents:
+        if 'rests' in doc:
+            state = dict(doc['rests'])
+        else:
+            apply_changes(state, doc.get('changes', {}))
+        yield doc, state
+
+
+def valid_alc_code(code: str) -> bool:
+    """ Алкокод можно использовать как имя поля rests.<алкокод>: без точек, $ и прочих символов """
+    return code.isalnum()
+
+
+def rests_projection(codes: Optional[List[str]]) -> Optional[dict]:
+    """ Проекция только на запрошенные алкокоды, чтобы остальные не передавались из базы """
+    if not codes:
+        return None
+
+    invalid = [code for code in codes if not valid_alc_code(code)]
+    if invalid:
+        raise ValueError(f'Некорректные алкокоды: {", ".join(invalid)}')
+
+    projection = {'date': 1}
+    for code in codes:
+        projection[f'rests.{code}'] = 1
+        projection[f'changes.{code}'] = 1
+
+    return projection
+
+
+def iter_rests(col, fsrar: str, is_retail: bool, date_from: Optional[datetime] = None,
+               date_till: Optional[datetime] = None, codes: Optional[List[str]] = None) -> Iterator[Tuple[datetime, dict]]:
+    """ Остатки на каждую дату запроса в периоде (date_from, date_till), опционально только по алкокодам
+    Чтение начинается с последнего опорного снимка до начала периода
+    """
+    query = {'fsrar': fsrar, 'is_retail': is_retail}
+    period = {}
+
+    if date_from is not None:
+        base = col.find_one({**query, 'rests': {'$exists': True}, 'date': {'$lte': date_from}}, {'date': 1},
+                            sort=[('date', DESCENDING)])
+        if base is not None:
+            period['$gte'] = base['date']
+
+    if date_till is not None:
+        period['$lt'] = date_till
+
+    if period:
+        query['date'] = period
+
+    documents = col.find(query, rests_projection(codes)).sort('date', ASCENDING)
+
+    for doc, state in replay_rests(documents):
+        if date_from is None or doc['date'] > date_from:
+            yield doc['date'], dict(state)
+
+
+def rests_before(col, fsrar: str, is_retail: bool, date: datetime) -> (Optional[datetime], dict):
+    """ Дата последнего опорного снимка и остатки непосредственно перед date """
+    query = {'fsrar': fsrar, 'is_retail': is_retail}
+    base = col.find_one({**query, 'rests': {'$exists': True}, 'date': {'$lt': date}}, {'date': 1},
+                        sort=[('date', DESCENDING)])
+    if base is None:
+        return None, {}
+
+    state = {}
+    documents = col.find({**query, 'date': {'$gte': base['date'], '$lt': date}}).sort('date', ASCENDING)
+    for _, state in replay_rests(documents):
+        pass
+
+    return base['date'], state
+
+
+def encode_rests(rests: dict, previous: dict, key_date: Optional[datetime], date: datetime,
+                 keyframe_days: int) -> dict:
+    """ Опорный снимок {rests: ...} или только изменения относительно предыдущих остатков {changes: ...} """
+    if key_date is None or date - key_date >= timedelta(days=keyframe_days):
+        return {'rests': rests}
+
+    changes = {code: quantity for code, quantity in rests.items() if previous.get(code) != quantity}
+    changes.update({code: None for code in previous if code not in rests})
+
+    if len(changes) * 2 > len(rests):
+        return {'rests': rests}
+
+    return {'changes': changes}
+
+
+def save_rests(col, fsrar: str, is_retail: bool, date: datetime, rests: dict, keyframe_days: int,
+               file: Optional[str] = None) -> bool:
+    """ Сохранение остатков на дату опорным снимком раз в keyframe_days дней, в остальные дни только изменения
+    Если уже есть более поздний документ с изменениями, он переписывается опорным снимком,
+    чтобы не зависеть от вставленного между ними документа. False, если остатки на дату уже сохранены
+    """
+    key = {'fsrar': fsrar, 'date': date, 'is_retail': is_retail}
+    if col.find_one(key, {'_id': 1}):
+        return False
+
+    key_date, previous = rests_before(col, fsrar, is_retail, date)
+
+    following = col.find_one({'fsrar': fsrar, 'is_retail': is_retail, 'date': {'$gt': date}},
+                             sort=[('date', ASCENDING)])
+    if following is not None and 'rests' not in following:
+        state = dict(previous)
+        apply_changes(state, following['changes'])
+        following.pop('changes')
+        col.replace_one({'_id': following.pop('_id')}, {**following, 'rests': state})
+
+    col.insert_one({**key, **encode_rests(rests, previous, key_date, date, keyframe_days), 'file': file})
+    return True
+
+
+def write_rests(col, fsrar: str, is_retail: bool, items: List[Tuple[datetime, dict, str]], keyframe_days: int) -> int:
+    """ Запись остатков одного регистра УТМ пачкой: [(дата, остатки, файл), ...]
+    Уже сохраненные даты пропускаются, запись через неупорядоченный bulk_write с upsert по уникальному ключу,
+    поэтому повторный запуск ничего не меняет. Даты раньше последней сохраненной пишутся по одной через save_rests
+    """
+    key = {'fsrar': fsrar, 'is_retail': is_retail}
+    items = sorted(items, key=lambda i: i[0])
+    stored = {d['date'] for d in col.find({**key, 'date': {'$in': [i[0] for i in items]}}, {'date': 1})}
+    items = [i for i in items if i[0] not in stored]
+    if not items:
+        return 0
+
+    last = col.find_one(key, {'date': 1}, sort=[('date', DESCENDING)])
+    if last is not None and last['date'] > items[0][0]:
+        return sum(save_rests(col, fsrar, is_retail, date, rests, keyframe_days, file) for date, rests, file in items)
+
+    key_date, previous = rests_before(col, fsrar, is_retail, items[0][0])
+    ops = []
+
+    for date, rests, file in items:
+        document = encode_rests(rests, previous, key_date, date, keyframe_days)
+        if 'rests' in document:
+            key_date = date
+        previous = rests
+
+        ops.append(UpdateOne({**key, 'date': date}, {'$setOnInsert': {**document, 'file': file}}, upsert=True))
+
+    return col.bulk_write(ops, ordered=False).upserted_count
+
+
+def rests_history(snapshots: Iterable[Tuple[datetime, dict]]) -> Dict[str, Dict[datetime, float]]:
+    """ История остатков по алкокодам {алкокод: {дата: количество}}
+    Разворот делается здесь, а не агрегацией в MongoDB: остатки на дату между опорными снимками есть только
+    после последовательного применения изменений (replay_rests), а из базы приходят лишь запрошенные алкокоды
+    """
+    history = {}
+    for date, rests in snapshots:
+        for code, quantity in rests.items():
+            history.setdefault(code, {})[date] = quantity
+
+    return dict(sorted(history.items()))
+
+
+def dedupe_rests(col) -> int:
+    """ Удаление повторных документов с одинаковыми (fsrar, is_retail, date), остается первый записанный
+    Возвращаем кол-во удаленных документов
+    """
+    pipeline = [
+        {'$group': {'_id': {'fsrar': '$fsrar', 'is_retail': '$is_retail', 'date': '$date'},
+                    'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ]
+    extra = [_id for d in col.aggregate(pipeline, allowDiskUse=True) for _id in sorted(d['ids'])[1:]]
+    if extra:
+        col.delete_many({'_id': {'$in': extra}})
+    return len(extra)
+
+
+def ensure_rests_indexes(col):
+    keys = [('fsrar', ASCENDING), ('is_retail', ASCENDING), ('date', ASCENDING)]
+
+    # ранее создавался неуникальный индекс с теми же полями
+    for index in list(col.list_indexes()):
+        if [(k, int(v)) for k, v in index['key'].items()] == keys and not index.get('unique'):
+            col.drop_index(index['name'])
+
+    try:
+        col.create_index(keys, unique=True)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        logging.error(f'ReplyRests duplicate (fsrar, is_retail, date) documents, removing: {e}')
+        logging.info(f'ReplyRests duplicates removed: {dedupe_rests(col)}')
+        col.create_index(keys, unique=True)
+
+    col.create_index([('fsrar', ASCENDING), ('file', ASCENDING)])
@@ -0,0 +1,29 @@
+// Обновление строк таблицы /status по событиям /status/stream без перезагрузки страницы
+(function () {
+    var rows = document.getElementById('status-rows');
+    if (!rows || !window.EventSource) {
+        return;
+    }
+
+    var source = new EventSource(rows.getAttribute('data-stream'));
+    source.addEventListener('row', function (event) {
+        var data = JSON.parse(event.data);
+        var row = document.getElementById('utm-' + data.fsrar);
+
+        if (!data.html) {
+            if (row) {
+                row.parentNode.removeChild(row);
+            }
+            return;
+        }
+
+        var holder = document.createElement('tbody');
+        holder.innerHTML = data.html.trim();
+        var fresh = holder.firstElementChild;
+        if (row) {
+            rows.replaceChild(fresh, row);
+        } else {
+            rows.appendChild(fresh);
+        }
+    });
+})();
@@ -0,0 +1,130 @@
+import time
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
+
+# Служебные поля, изменение которых не считается изменением состояния УТМ.
+# date результата опроса - время опроса, в status не хранится; changed - время последнего изменения УТМ
+SKIP_FIELDS = ('_id', 'date', 'changed', 'active')
+
+
+def ensure_status_indexes(col, changes):
+    migrate_status_dates(col)
+    col.create_index([('fsrar', ASCENDING)], unique=True)
+    col.create_index([('active', ASCENDING)])
+    col.create_index([('changed', ASCENDING)])
+    changes.create_index([('fsrar', ASCENDING), ('date', DESCENDING)])
+    changes.create_index([('date', DESCENDING)])
+
+
+def migrate_status_dates(col):
+    """ Время последнего изменения раньше хранилось в date, переносим его в changed """
+    ops = [UpdateOne({'_id': d['_id']}, {'$set': {'changed': d['date']}, '$unset': {'date': ''}})
+           for d in col.find({'changed': {'$exists': False}, 'date': {'$exists': True}}, {'date': 1})]
+    if ops:
+        col.bulk_write(ops, ordered=False)
+    if 'date_1' in col.index_information():
+        col.drop_index('date_1')
+
+
+def status_diff(current: Optional[dict], doc: dict) -> dict:
+    """ Поля результата опроса, которые отличаются от текущего состояния УТМ """
+    fields = {k: v for k, v in doc.items() if k not in SKIP_FIELDS}
+    if current is None:
+        return fields
+
+    return {k: v for k, v in fields.items() if current.get(k) != v}
+
+
+def save_status(col, changes, docs: Iterable[dict], active: Iterable[str], date: Optional[datetime] = None) -> int:
+    """ Сохранение результатов опроса: текущий документ УТМ обновляется только при изменении полей,
+    время изменения пишется в changed, каждое изменение добавляется в журнал changes.
+    Неактивными помечаются УТМ, которых нет среди активных в реестре (active), а не те, что еще не опрошены:
+    после перезапуска опроса результаты приходят постепенно. Возвращаем кол-во изменившихся УТМ
+    """
+    date = date or datetime.now()
+    docs = list(docs)
+    current = {d['fsrar']: d for d in col.find({}, {'_id': 0})}
+    ops: List[UpdateOne] = []
+    log: List[dict] = []
+
+    for doc in docs:
+        fsrar = doc['fsrar']
+        before = current.get(fsrar)
+        diff = status_diff(before, doc)
+        if not diff and before.get('active'):
+            continue
+
+        ops.append(UpdateOne({'fsrar': fsrar}, {'$set': {**diff, 'active': True, 'changed': date}}, upsert=True))
+        if diff:
+            log.append({'fsrar': fsrar, 'date': date, 'changes': diff})
+
+    if ops:
+        col.bulk_write(ops, ordered=False)
+    if log:
+        changes.insert_many(log)
+
+    removed = col.update_many({'active': True, 'fsrar': {'$nin': list(active)}},
+                              {'$set': {'active': False, 'changed': date}})
+    return len(ops) + removed.modified_count
+
+
+def watch_status(col, since: datetime, poll: float, keepalive: float) -> Iterator[Optional[dict]]:
+    """ Документы УТМ, изменившиеся после since, по мере записи опроса; None - изменений не было дольше keepalive
+    Если база - набор реплик, изменения приходят из change stream, иначе коллекция опрашивается по полю changed.
+    Каждое сохранение (в том числе снятие active) обновляет changed, поэтому опрос не пропускает изменений
+    """
+    try:
+        stream = col.watch([{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}],
+                           full_document='updateLookup', max_await_time_ms=int(poll * 1000))
+    except OperationFailure:
+        stream = None
+
+    # Один опрос пишет все УТМ с одной датой, но не атомарно: на границе запоминаем уже отданные УТМ.
+    # Строки с датой since уже есть на странице
+    seen = {(d['fsrar'], d['changed']) for d in col.find({'changed': since}, {'fsrar': 1, 'changed': 1})}
+    quiet = time.monotonic()
+
+    def changed() -> List[dict]:
+        nonlocal since, seen
+        docs = [d for d in col.find({'changed': {'$gte': since}}, {'_id': 0}).sort('changed', ASCENDING)
+                if (d['fsrar'], d['changed']) not in seen]
+        for d in docs:
+            if d['changed'] > since:
+                since, seen = d['changed'], set()
+            seen.add((d['fsrar'], d['changed']))
+        return docs
+
+    # Изменения между отрисовкой страницы и открытием потока
+    yield from changed()
+
+    if stream is not None:
+        try:
+            with stream:
+                while stream.alive:
+                    change = stream.try_next()
+                    doc = change.get('fullDocument') if change is not None else None
+                    if doc is not None:
+                        doc.pop('_id', None)
+                        since = max(since, doc['changed'])
+                        quiet = time.monotonic()
+                        yield doc
+                    elif time.monotonic() - quiet >= keepalive:
+                        quiet = time.monotonic()
+                        yield None
+        except PyMongoError:
+            pass
+        # Поток закрыт сервером, дальше опрашиваем по changed
+        seen = set()
+
+    while True:
+        docs = changed()
+        if docs:
+            quiet = time.monotonic()
+            yield from docs
+        elif time.monotonic() - quiet >= keepalive:
+            quiet = time.monotonic()
+            yield None
+        time.sleep(poll)
@@ -0,0 +1,178 @@
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+import xmltodict
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+RE_TERM = re.compile(r'[\w\-/]+')
+BULK_SIZE = 1000
+
+
+def local_name(key: str) -> str:
+    return key.split(':')[-1]
+
+
+def find_value(data, name: str) -> Optional[str]:
+    """ Первое значение поля по имени без префикса пространства имен на любой вложенности """
+    if not isinstance(data, dict):
+        return None
+
+    for key, value in data.items():
+        if local_name(key) == name and not isinstance(value, dict):
+            return value
+
+    for value in data.values():
+        found = find_value(value, name)
+        if found is not None:
+            return found
+
+    return None
+
+
+def leaf_values(data) -> Iterator[str]:
+    if isinstance(data, dict):
+        for value in data.values():
+            yield from leaf_values(value)
+    elif isinstance(data, list):
+        for value in data:
+            yield from leaf_values(value)
+    elif data is not None:
+        yield str(data)
+
+
+def ticket_terms(ticket: dict) -> List[str]:
+    """ Поисковые слова квитанции: все значения полей целиком и по словам, в нижнем регистре """
+    terms = set()
+    for value in leaf_values(ticket):
+        value = value.strip().lower()
+        terms.add(value)
+        terms.update(RE_TERM.findall(value))
+
+    return sorted(t for t in terms if t)
+
+
+def parse_ticket(raw_data: str) -> Optional[dict]:
+    """ Содержимое ns:Ticket из документа обмена """
+    ticket_dict = xmltodict.parse(raw_data)
+    return ticket_dict.get('ns:Documents').get('ns:Document').get('ns:Ticket')
+
+
+def ticket_document(fsrar: str, name: str, mtime: float, size: int, ticket: dict) -> dict:
+    """ Запись индекса: разобранные поля квитанции, исходный ns:Ticket и поисковые слова """
+    return {
+        'fsrar': fsrar,
+        'name': name,
+        'mtime': mtime,
+        'size': size,
+        'doc_id': find_value(ticket, 'DocId'),
+        'reg_id': find_value(ticket, 'RegID'),
+        'result': find_value(ticket, 'Conclusion') or find_value(ticket, 'OperationResult'),
+        'date': find_value(ticket, 'TicketDate'),
+        'comments': find_value(ticket, 'Comments') or find_value(ticket, 'OperationComment'),
+        'ticket': ticket,
+        'terms': ticket_terms(ticket) + [name.lower()] if ticket is not None else [],
+    }
+
+
+def scan_tickets(path: str, root: str = '') -> Iterator[Tuple[str, os.DirEntry]]:
+    """ Файлы квитанций в каталоге обмена и подкаталогах, stat берется из листинга каталога """
+    with os.scandir(os.path.join(path, root)) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield from scan_tickets(path, os.path.join(root, entry.name))
+            elif entry.name.find('Ticket') > 0:
+                yield os.path.join(root, entry.name), entry
+
+
+def ensure_ticket_indexes(col):
+    col.create_index([('fsrar', ASCENDING), ('name', ASCENDING)], unique=True)
+    col.create_index([('fsrar', ASCENDING), ('terms', ASCENDING), ('name', DESCENDING)])
+
+
+def write_ops(col, ops: list) -> int:
+    result = col.bulk_write(ops, ordered=False)
+    return result.upserted_count + result.modified_count
+
+
+def update_ticket_index(col, fsrar: str, path: str, max_files: Optional[int] = None) -> (int, int, int):
+    """ Обновление индекса квитанций УТМ: читаются только новые и изменившиеся по mtime/size файлы,
+    записи удаленных файлов удаляются. За один вызов читается не больше max_files файлов, остальные
+    дочитываются следующими вызовами. Возвращаем кол-во обновленных и удаленных записей и непрочитанных файлов
+    """
+    known = {d['name']: (d['mtime'], d['size']) for d in col.find({'fsrar': fsrar}, {'name': 1, 'mtime': 1, 'size': 1})}
+    seen = set()
+    ops = []
+    updated = read = pending = 0
+
+    for name, entry in scan_tickets(path):
+        seen.add(name)
+        stat = entry.stat()
+        if known.get(name) == (stat.st_mtime, stat.st_size):
+            continue
+
+        if max_files is not None and read >= max_files:
+            pending += 1
+            continue
+        read += 1
+
+        # Нераспознанные файлы тоже попадают в индекс, чтобы не перечитывать их при каждом обновлении
+        try:
+            with open(entry.path, encoding='utf8') as f:
+                ticket = parse_ticket(f.read())
+        except Exception as e:
+            logging.error(f'Ticket SKIPPED {entry.path} {e}')
+            ticket = None
+
+        document = ticket_document(fsrar, name, stat.st_mtime, stat.st_size, ticket)
+        ops.append(UpdateOne({'fsrar': fsrar, 'name': name}, {'$set': document}, upsert=True))
+
+        if len(ops) >= BULK_SIZE:
+            updated += write_ops(col, ops)
+            ops = []
+
+    if ops:
+        updated += write_ops(col, ops)
+
+    removed = [name for name in known if name not in seen]
+    if removed:
+        col.delete_many({'fsrar': fsrar, 'name': {'$in': removed}})
+
+    return updated, len(removed), pending
+
+
+def refresh_ticket_index(col, scans, fsrar: str, path: str, max_age: int, max_files: int) -> int:
+    """ Обновление индекса УТМ из веб-запроса, если последнее обновление старше max_age секунд
+    Читается не больше max_files файлов, пока индекс не дочитан, время обновления не сохраняется,
+    и следующий поиск продолжает чтение. Полностью индекс строит get_tickets.py.
+    Возвращаем кол-во непрочитанных файлов
+    """
+    last = scans.find_one({'fsrar': fsrar})
+    if last is not None and (datetime.now() - last['date']).total_seconds() < max_age:
+        return 0
+
+    ensure_ticket_indexes(col)
+    updated, removed, pending = update_ticket_index(col, fsrar, path, max_files)
+    if not pending:
+        scans.replace_one({'fsrar': fsrar}, {'fsrar': fsrar, 'date': datetime.now()}, upsert=True)
+    logging.info(f'Ticket index {fsrar}: обновлено {updated}, удалено {removed}, осталось {pending}')
+    return pending
+
+
+def search_tickets(col, fsrar: str, search: str, limit: int) -> List[dict]:
+    """ Поиск квитанций по началу слова или значения поля, новые квитанции первыми
+    Если по началу ничего не найдено, ищем подстроку в словах (например, номер без префикса TTN-),
+    такой поиск перебирает все слова квитанций УТМ и поэтому медленнее
+    """
+    search = re.escape(search.strip().lower())
+    projection = {'ticket': 1}
+
+    query = {'fsrar': fsrar, 'terms': {'$regex': f'^{search}'}}
+    results = [d['ticket'] for d in col.find(query, projection).sort('name', DESCENDING).limit(limit)]
+    if results:
+        return results
+
+    query = {'fsrar': fsrar, 'terms': {'$regex': search}}
+    return [d['ticket'] for d in col.find(query, projection).sort('name', DESCENDING).limit(limit)]
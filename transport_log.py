@@ -0,0 +1,132 @@
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Iterator, Optional
+
+# Сколько первых байт журнала хранить для распознавания ротации, если inode на шаре не поддерживается
+HEAD_SIZE = 256
+CHUNK_SIZE = 4 * 1024 * 1024
+
+CHEQUE_TEXT = 'Получен чек.'.encode('utf8')
+ERROR_TAG = b'<error>'
+RE_ERROR = re.compile(rb'<error>(.*)</error>')
+
+
+def file_fingerprint(filename: str) -> dict:
+    """ Отпечаток файла журнала: inode, размер и начало файла """
+    with open(filename, 'rb') as file:
+        stat = os.fstat(file.fileno())
+        head = file.read(HEAD_SIZE)
+
+    return {'ino': str(stat.st_ino), 'size': stat.st_size, 'head': head}
+
+
+def resume_offset(state: Optional[dict], fingerprint: dict) -> int:
+    """ Позиция, с которой продолжать разбор; 0 если журнал новый, был ротирован или обрезан """
+    if not state:
+        return 0
+
+    offset = state.get('offset', 0)
+    saved_head = state.get('head', b'')
+    head = fingerprint['head'][:len(saved_head)]
+
+    if state.get('ino') != fingerprint['ino'] or fingerprint['size'] < offset or head != saved_head:
+        logging.info(f'Журнал ротирован или обрезан, полный разбор: {state.get("fsrar")}')
+        return 0
+
+    return offset
+
+
+def parse_log_time(line: bytes) -> datetime:
+    """ Время события из фиксированного начала строки YYYY-MM-DD HH:MM:SS без strptime """
+    return datetime(int(line[0:4]), int(line[5:7]), int(line[8:10]),
+                    int(line[11:13]), int(line[14:16]), int(line[17:19]))
+
+
+def iter_log_chunks(file, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """ Чтение журнала крупными блоками, каждый блок заканчивается на границе строки
+    Незавершенная последняя строка файла не возвращается
+    """
+    tail = b''
+
+    while True:
+        data = file.read(chunk_size)
+        if not data:
+            break
+
+        data = tail + data
+        complete = data.rfind(b'\n') + 1
+        tail = data[complete:]
+
+        if complete:
+            yield data[:complete]
+
+
+class LogScanner(object):
+    """ Потоковый разбор журнала транзакций
+    Итерация возвращает события с ошибками [время, текст], по ходу считаются чеки и разобранные байты.
+    Регулярное выражение применяется только к строкам, в которых найден <error>,
+    поэтому память не зависит от размера журнала, а большая часть строк не декодируется вовсе.
+    """
+
+    def __init__(self, file, chunk_size: int = CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.cheques: int = 0
+        self.consumed: int = 0
+
+    def __iter__(self) -> Iterator[list]:
+        for chunk in iter_log_chunks(self.file, self.chunk_size):
+            self.consumed += len(chunk)
+            self.cheques += chunk.count(CHEQUE_TEXT)
+            yield from self._chunk_errors(chunk)
+
+    @staticmethod
+    def _chunk_errors(chunk: bytes) -> Iterator[list]:
+        position = chunk.find(ERROR_TAG)
+
+        while position != -1:
+            line_start = chunk.rfind(b'\n', 0, position) + 1
+            line_end = chunk.find(b'\n', position)
+            line = chunk[line_start:line_end]
+            position = chunk.find(ERROR_TAG, line_end)
+
+            if CHEQUE_TEXT in line:
+                continue
+
+            error_result = RE_ERROR.search(line)
+            if error_result is None:
+                continue
+
+            try:
+                error_time = parse_log_time(line)
+            except ValueError:
+                logging.warning(f'Не распознано время события: {line[:40]}')
+                continue
+
+            yield [error_time, error_result.group(1).decode('utf8', errors='replace')]
+
+
+def parse_log_for_errors(filename: str, offset: int = 0) -> (list, int, Optional[str], int):
+    """ Возвращаем список событий с ошибками, кол-во чеков в логе и позицию конца разобранных строк
+    Разбор начинается с offset, незавершенная последняя строка остается до следующего запуска
+    """
+    error_mark_events = []
+    cheques_counter = 0
+    err = None
+    end = offset
+
+    try:
+        with open(filename, 'rb') as file:
+            file.seek(offset)
+            scanner = LogScanner(file)
+            error_mark_events = list(scanner)
+            cheques_counter = scanner.cheques
+            end = offset + scanner.consumed
+
+    except (OSError, TypeError):
+        err = 'Недоступен или журнал не найден'
+        logging.error(f'{err} {filename}')
+
+    return error_mark_events, cheques_counter, err, end
@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+import MySQLdb
+
+
+class PoolExhausted(Exception):
+    """ Нет свободного соединения за отведенное время """
+
+
+class ConnectionPool(object):
+    """ Пул соединений MySQL к одному серверу УКМ
+    * не больше max_size соединений одновременно, включая простаивающие
+    * соединения, простаивающие дольше idle_timeout, закрываются
+    * соединение, простоявшее дольше ping_after, проверяется ping() перед выдачей
+    * соединение, на котором произошла ошибка MySQL, в пул не возвращается
+    """
+
+    def __init__(self, connect: Callable, max_size: int, idle_timeout: float, ping_after: float, wait: float):
+        self._connect = connect
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle: List[tuple] = []
+        self._lock = threading.Lock()
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.wait = wait
+
+    def _evict_idle(self):
+        """ Закрываем давно простаивающие соединения """
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            expired = [c for c, t in self._idle if t < deadline]
+            self._idle = [(c, t) for c, t in self._idle if t >= deadline]
+
+        for connection in expired:
+            self._close(connection)
+
+    def _checkout(self):
+        self._evict_idle()
+
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, released = self._idle.pop()
+
+            if time.monotonic() - released < self.ping_after:
+                return connection
+
+            try:
+                connection.ping()
+                return connection
+            except MySQLdb.Error:
+                self._close(connection)
+
+        connection = self._connect()
+        connection.autocommit(True)
+        return connection
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except MySQLdb.Error:
+            pass
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self.wait):
+            raise PoolExhausted(f'Нет свободного соединения за {self.wait} с')
+
+        connection = None
+        try:
+            connection = self._checkout()
+            yield connection
+
+        except MySQLdb.Error:
+            if connection is not None:
+                self._close(connection)
+                connection = None
+            raise
+
+        finally:
+            if connection is not None:
+                with self._lock:
+                    self._idle.append((connection, time.monotonic()))
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection, _ in idle:
+            self._close(connection)
+
+
+class UkmPools(object):
+    """ Пулы соединений к серверам УКМ, по одному на хост
+    Общие параметры подключения не изменяются, хост передается отдельно при создании соединения
+    """
+
+    def __init__(self, conn_params: dict, max_size: int, idle_timeout: float, ping_after: float, wait: float):
+        self.conn_params = dict(conn_params)
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.wait = wait
+        self._pools: Dict[str, ConnectionPool] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str) -> ConnectionPool:
+        with self._lock:
+            pool = self._pools.get(host)
+            if pool is None:
+                logging.info(f'Новый пул соединений УКМ {host}')
+                pool = ConnectionPool(lambda: MySQLdb.connect(host=host, **self.conn_params),
+                                      self.max_size, self.idle_timeout, self.ping_after, self.wait)
+                self._pools[host] = pool
+
+        return pool
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+
+        for pool in pools:
+            pool.close()
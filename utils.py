@@ -1,71 +1,80 @@
-import re
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from grab import Grab
-from grab.error import GrabCouldNotResolveHostError, GrabConnectionError, GrabTimeoutError
-from weblib.error import DataNotFound
+from grab.error import GrabCouldNotResolveHostError, GrabConnectionError, GrabTimeoutError, GrabNetworkError
 
 from app import Result, Utm
+from config import AppConfig
+from utm_home import NO_CHEQUES, HomePage, last_date, parse_certificate
 
 
-def parse_utm(utm: Utm) -> Result:
-    """ Парсер УТМ получает всю необходимую информацию с главной страницы и сертификата"""
+def utm_grab() -> Grab:
+    """ Grab с ограничением времени подключения и ответа, чтобы недоступный УТМ не задерживал опрос """
+    return Grab(connect_timeout=AppConfig.UTM_CONNECT_TIMEOUT, timeout=AppConfig.UTM_READ_TIMEOUT)
 
-    def last_date(date_string: str):
-        return re.findall('\d{4}-\d{2}-\d{2}', date_string)[-1]
 
+OFFLINE = 'Нет связи'
+CERT_FIELDS = ('legal', 'surname', 'given_name')
+
+
+def is_offline(result: Result) -> bool:
+    return result.error.startswith(OFFLINE)
+
+
+def parse_utm(utm: Utm, with_cert: bool = True) -> Result:
+    """ Парсер УТМ получает всю необходимую информацию с главной страницы и сертификата
+    Без with_cert страница сертификата не запрашивается и поля CERT_FIELDS остаются пустыми
+    """
     result = Result(utm)
-    div_inc = 0
-    homepage, gostpage = Grab(), Grab()
+    homepage, gostpage = utm_grab(), utm_grab()
 
     try:
         homepage.go(utm.build_url())
-        gostpage.go(utm.gost_url())
+        if with_cert:
+            gostpage.go(utm.gost_url())
+
+        home = HomePage(homepage.doc.unicode_body())
+        fields = home.fields
+
         # версия
-        try:
-            result.version = homepage.doc.select('//*[@id="home"]/div[1]/div[2]').text()
-            result.change_set = homepage.doc.select('//*[@id="home"]/div[2]/div[2]').text()
-            result.build = homepage.doc.select('//*[@id="home"]/div[3]/div[2]').text()
-        except DataNotFound:
+        if 'version' in fields:
+            result.version = fields['version']
+            result.change_set = fields.get('change_set', '')
+            result.build = fields.get('build', '')
+        else:
             result.error.append('Не найдена информация о версии\n')
 
         # ИД
-        try:
-            fsrar_id = homepage.doc.select('//*[@id="RSA"]/div[2]').text()
-            if utm.fsrar != fsrar_id.split(' ')[1].split('-')[2].split('_')[0]:
-                result.error.append('ФСРАР не соответствует\n')
-        except DataNotFound:
+        if home.rsa is None:
             result.error.append('Не найден ФСРАР ид\n')
+        else:
+            try:
+                if utm.fsrar != home.rsa.split(' ')[1].split('-')[2].split('_')[0]:
+                    result.error.append('ФСРАР не соответствует\n')
+            except IndexError:
+                result.error.append('ФСРАР не соответствует\n')
 
         # Самодиагностика
-        try:
-            status_string = homepage.doc.select('//*[@id="home"]/div[4]/div[2]').text()
-            result.status = 'RSA сертификат pki.fsrar.ru соответствует контуру' == status_string
-            # если сатус не соотвествует указанному,значит появился блок Проблема с RSA и нумерация блоков увеличилась
-            div_inc = not result.status
-            license_string = homepage.doc.select(f'//*[@id="home"]/div[{5 + div_inc}]/div[2]').text()
-            filter_string = homepage.doc.select('//*[@id="filterMsgDiv"]').text()
-            result.filter = 'Обновление настроек не требуется' == filter_string
-            result.license = 'Лицензия на вид деятельности действует' == license_string
-
-        except DataNotFound:
+        if home.found and home.filter_message is not None:
+            result.status = home.status
+            result.filter = home.filter
+            result.license = home.license
+        else:
             result.error.append('Не найдены все элементы на странице\n')
 
         # ключи
         try:
-            gost_string = homepage.doc.select(f'//*[@id="home"]/div[{9 + div_inc}]/div[2]').text()
-            pki_string = homepage.doc.select(f'//*[@id="home"]/div[{8 + div_inc}]/div[2]').text()
-            result.pki = last_date(pki_string)
-            result.gost = last_date(gost_string)
-        except (IndexError, DataNotFound):
+            result.pki = last_date(fields['pki'])
+            result.gost = last_date(fields['gost'])
+        except (IndexError, KeyError):
             result.error.append('Не найдены сроки ключей\n')
 
         # Дата отправки последнего чека не должна быть старше одного дня
         try:
-            cheque_string = homepage.doc.select(f'// *[@id="home"]/div[{7 + div_inc}]/div[2]').text()
+            cheque_string = fields['cheques']
             today = datetime.strftime(datetime.now(), "%Y-%m-%d")
 
-            if cheque_string == 'Отсутствуют неотправленные чеки':
+            if cheque_string == NO_CHEQUES:
                 result.cheques = 'OK'
             elif last_date(cheque_string) == today:
                 result.cheques = 'OK'
@@ -74,37 +83,31 @@ def parse_utm(utm: Utm) -> Result:
         except Exception as e:
             result.error.append(f'Проблема с отправкой чеков: {e}\n')
 
-        try:
-            pre = gostpage.doc.select('//pre').text()
-            cn = re.compile(r'(?<=CN=)[^,]*')
-            name = re.compile(r'(?<=GIVENNAME=)[^,]*')
-            surname = re.compile(r'(?<=SURNAME=)[^,]*')
-
-            cn_res = cn.search(pre)
-            if cn_res is not None:
-                result.legal = cn_res.group().replace('"', '').replace('\\', '').replace('ООО', '')[0:20]
-
-            surname_res = surname.search(pre)
-            if surname_res is not None:
-                result.surname = surname_res.group()
+        if with_cert:
+            try:
+                certificate = parse_certificate(gostpage.doc.unicode_body())
+                if certificate is None:
+                    raise ValueError(': нет текста сертификата')
+                for field, value in certificate.items():
+                    setattr(result, field, value)
 
-            name_res = name.search(pre)
-            if name_res is not None:
-                result.given_name = name_res.group()
-
-        except Exception as e:
-            result.error.append(f'Не найден сертификат организации{e}\n')
+            except Exception as e:
+                result.error.append(f'Не найден сертификат организации{e}\n')
 
     # не удалось соединиться
     except GrabTimeoutError:
-        result.error.append('Нет связи: время истекло')
+        result.error.append(f'{OFFLINE}: время истекло')
 
     except GrabCouldNotResolveHostError:
-        result.error.append('Нет связи: не найден сервер')
+        result.error.append(f'{OFFLINE}: не найден сервер')
 
     except GrabConnectionError:
-        result.error.append('Нет связи: ошибка подключения')
+        result.error.append(f'{OFFLINE}: ошибка подключения')
+
+    except GrabNetworkError as e:
+        result.error.append(f'{OFFLINE}: {e}')
 
     result.error = ' '.join(result.error)
 
     return result
+
@@ -0,0 +1,48 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Повторы только для идемпотентных запросов, POST повторяется лишь при ошибке подключения
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'DELETE', 'OPTIONS'})
+
+# Ошибки, при которых УТМ считается недоступным
+UtmUnavailable = (requests.ConnectionError, requests.Timeout)
+
+
+class UtmClient(object):
+    """ HTTP клиент для REST УТМ
+    Одна сессия с keep-alive пулом соединений на каждый хост, таймауты подключения и чтения
+    по умолчанию для всех запросов, ограниченные повторы с нарастающей задержкой
+    """
+
+    def __init__(self, connect_timeout: float, read_timeout: float, retries: int, backoff: float,
+                 pool_hosts: int, pool_size: int):
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            allowed_methods=IDEMPOTENT_METHODS,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, **kwargs)
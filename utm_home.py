@@ -0,0 +1,183 @@
+import logging
+import re
+from typing import Dict, List, Optional, Union
+
+import lxml.html
+
+RE_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+RE_CN = re.compile(r'(?<=CN=)[^,]*')
+RE_GIVENNAME = re.compile(r'(?<=GIVENNAME=)[^,]*')
+RE_SURNAME = re.compile(r'(?<=SURNAME=)[^,]*')
+
+STATUS_OK = 'RSA сертификат pki.fsrar.ru соответствует контуру'
+LICENSE_OK = 'Лицензия на вид деятельности действует'
+FILTER_OK = 'Обновление настроек не требуется'
+NO_CHEQUES = 'Отсутствуют неотправленные чеки'
+
+# Строки блока #home главной страницы УТМ: поле -> варианты начала подписи в нижнем регистре.
+# Порядок важен: строка достается первому подходящему полю. Подписи не сверены со всеми версиями УТМ,
+# поэтому значение по подписи принимается, только если подходит под вид поля (FIELD_CHECKS),
+# иначе поле берется по номеру строки (HOME_POSITIONS)
+HOME_LABELS = (
+    ('gost', ('сертификат гост', 'гост')),
+    ('pki', ('сертификат rsa', 'rsa сертификат', 'сертификат pki')),
+    ('version', ('версия',)),
+    ('change_set', ('changeset', 'набор изменений')),
+    ('build', ('дата сборки', 'сборка', 'build')),
+    ('cheques', ('чеки', 'неотправленные чеки')),
+)
+
+
+# Номера строк #home (с 0), по которым поля брал прежний разбор; при «Проблема с RSA» появляется
+# дополнительная строка после проверки RSA, и следующие строки сдвигаются на одну
+HOME_POSITIONS = {'version': 0, 'change_set': 1, 'build': 2, 'cheques': 6, 'pki': 7, 'gost': 8}
+RSA_ROW = 3
+
+# Вид значения поля: сроки ключей и чеки содержат дату, версия и сборка - цифры
+FIELD_CHECKS = {
+    'gost': lambda v: RE_DATE.search(v) is not None,
+    'pki': lambda v: RE_DATE.search(v) is not None,
+    'cheques': lambda v: v == NO_CHEQUES or RE_DATE.search(v) is not None,
+    'version': lambda v: any(c.isdigit() for c in v),
+    'build': lambda v: any(c.isdigit() for c in v),
+    'change_set': bool,
+}
+
+# Наборы подписей, о которых уже предупреждали, чтобы не повторять предупреждение на каждом опросе
+_reported_labels = set()
+
+
+def normalize(text: Optional[str]) -> str:
+    """ Текст без лишних пробелов и переводов строк, как в Grab """
+    return ' '.join(text.split()) if text else ''
+
+
+def last_date(text: str) -> str:
+    return RE_DATE.findall(text)[-1]
+
+
+def home_rows(home) -> List[Optional[tuple]]:
+    """ Строки #home по порядку: (подпись, значение) для div с div подписи и div значения, иначе None """
+    rows = []
+    for row in home.iterchildren('div'):
+        cells = list(row.iterchildren('div'))
+        if len(cells) >= 2:
+            rows.append((normalize(cells[0].text_content()), normalize(cells[1].text_content())))
+        else:
+            rows.append(None)
+    return rows
+
+
+def valid_value(field: str, value: str) -> bool:
+    check = FIELD_CHECKS.get(field)
+    return check is None or check(value)
+
+
+def position_fields(rows: List[Optional[tuple]], shifted: bool) -> Dict[str, tuple]:
+    """ Строки (подпись, значение) полей по номерам строк, как в прежнем разборе """
+    fields = {}
+    for field, position in HOME_POSITIONS.items():
+        position += shifted and position > RSA_ROW
+        if position < len(rows) and rows[position] is not None:
+            fields[field] = rows[position]
+    return fields
+
+
+def label_matches(field: str, label: str) -> bool:
+    return any(f == field and label.lower().startswith(prefixes) for f, prefixes in HOME_LABELS)
+
+
+def label_fields(rows: Dict[str, str]) -> Dict[str, str]:
+    """ Значения полей по подписям строк; значение, не подходящее под вид поля, пропускается """
+    fields = {}
+    for label, value in rows.items():
+        lower = label.lower()
+        for field, prefixes in HOME_LABELS:
+            if field not in fields and lower.startswith(prefixes) and valid_value(field, value):
+                fields[field] = value
+                break
+    return fields
+
+
+class HomePage(object):
+    """ Разобранная главная страница УТМ
+    Блок #home обходится один раз, значения берутся по подписям строк, а не по номерам div,
+    поэтому дополнительный блок (например, «Проблема с RSA») не сдвигает остальные поля.
+    Страница передается текстом: байты без <meta charset> lxml декодирует как latin-1
+    """
+
+    def __init__(self, html: Union[str, bytes]):
+        tree = lxml.html.fromstring(html)
+
+        home = tree.get_element_by_id('home', None)
+        row_list = home_rows(home) if home is not None else []
+        self.rows = dict(r for r in row_list if r is not None)
+        self.values = set(self.rows.values())
+        self.fields = label_fields(self.rows)
+
+        # Поля, взятые по номерам строк, а не по подписям, и поля, у которых значение по подписи
+        # расходится с подходящим значением по номеру строки (значение по подписи, значение по номеру).
+        # Если у строки на прежнем месте тоже подходящая подпись, верим ей: короткий префикс
+        # мог совпасть с подписью другой строки раньше
+        rows = position_fields(row_list, not self.status) if self.rows else {}
+        positions = {f: value for f, (_, value) in rows.items()}
+        self.by_position = [f for f in HOME_POSITIONS if f not in self.fields and f in positions]
+        self.conflicts = {f: (self.fields[f], positions[f]) for f in HOME_POSITIONS
+                          if f in positions and f not in self.by_position and self.fields[f] != positions[f]
+                          and valid_value(f, positions[f])}
+        self.by_position += [f for f in self.conflicts if label_matches(f, rows[f][0])]
+        self.fields.update({f: positions[f] for f in self.by_position})
+
+        labels = tuple(self.rows)
+        if (self.by_position or self.conflicts) and labels not in _reported_labels:
+            _reported_labels.add(labels)
+            logging.warning(f'Подписи строк главной страницы УТМ не распознаны, поля по номерам строк: '
+                            f'{self.by_position}, расхождения подписи и номера строки: {self.conflicts}, '
+                            f'подписи на странице: {list(labels)}')
+
+        rsa = tree.get_element_by_id('RSA', None)
+        rsa_cells = list(rsa.iterchildren('div')) if rsa is not None else []
+        self.rsa = normalize(rsa_cells[1].text_content()) if len(rsa_cells) >= 2 else None
+
+        msg = tree.get_element_by_id('filterMsgDiv', None)
+        self.filter_message = normalize(msg.text_content()) if msg is not None else None
+
+    @property
+    def found(self) -> bool:
+        return bool(self.rows)
+
+    @property
+    def status(self) -> bool:
+        return STATUS_OK in self.values
+
+    @property
+    def license(self) -> bool:
+        return LICENSE_OK in self.values
+
+    @property
+    def filter(self) -> bool:
+        return self.filter_message == FILTER_OK
+
+
+def parse_certificate(html: Union[str, bytes]) -> Optional[dict]:
+    """ Организация и директор из текста сертификата ГОСТ (тег pre), None если сертификата нет на странице """
+    pre = lxml.html.fromstring(html).find('.//pre')
+    if pre is None:
+        return None
+
+    text = normalize(pre.text_content())
+    certificate = {}
+
+    cn = RE_CN.search(text)
+    if cn is not None:
+        certificate['legal'] = cn.group().replace('"', '').replace('\\', '').replace('ООО', '')[0:20]
+
+    surname = RE_SURNAME.search(text)
+    if surname is not None:
+        certificate['surname'] = surname.group()
+
+    given_name = RE_GIVENNAME.search(text)
+    if given_name is not None:
+        certificate['given_name'] = given_name.group()
+
+    return certificate
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def run_parallel(func: Callable[[T], R], items: Iterable[T], workers: int) -> List[R]:
+    """ Выполнение func для каждого элемента в пуле потоков, порядок результатов совпадает с порядком элементов """
+    items = list(items)
+    if not items:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items)))) as executor:
+        return list(executor.map(func, items))
+
+
+def iter_bounded(func: Callable[[T], R], items: Iterable[T], workers: int, timeout: float,
+                 before: Optional[Callable[[T], None]] = None) -> Iterator[Tuple[int, Optional[R], Optional[Exception]]]:
+    """ Выполнение func в пуле потоков с ограничением времени на каждый элемент
+    Возвращает тройки (индекс, результат, исключение) по мере готовности элементов. Элемент, который выполняется
+    дольше timeout, получает TimeoutError и больше не ожидается, остальные элементы продолжают выполняться.
+    Зависший поток нельзя прервать, поэтому он занимает место в пуле до своего завершения;
+    если все потоки пула заняты зависшими задачами, оставшиеся элементы тоже получают TimeoutError.
+    Если перебор прерван, еще не начатые элементы отменяются.
+    before(элемент) выполняется в том же потоке до начала отсчета timeout, например ожидание RateLimiter.
+    """
+    items = list(items)
+    if not items:
+        return
+
+    max_workers = max(1, min(workers, len(items)))
+    started = {}
+
+    def task(i: int) -> R:
+        if before is not None:
+            before(items[i])
+        started[i] = time.monotonic()
+        return func(items[i])
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {executor.submit(task, i): i for i in range(len(items))}
+    pending, abandoned = set(futures), set()
+    poll = min(1.0, timeout / 10)
+
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=poll, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    yield futures[future], None, e
+                else:
+                    yield futures[future], result, None
+
+            now = time.monotonic()
+            for future in list(pending):
+                i = futures[future]
+                if i in started and now - started[i] > timeout:
+                    logging.warning(f'Превышено время выполнения {timeout} с: {items[i]}')
+                    pending.discard(future)
+                    abandoned.add(future)
+                    yield i, None, TimeoutError(f'Превышено время ожидания {timeout} с')
+
+            abandoned = {f for f in abandoned if not f.done()}
+            if len(abandoned) >= max_workers:
+                stuck, pending = pending, set()
+                for future in stuck:
+                    future.cancel()
+                    yield futures[future], None, TimeoutError('Все потоки заняты зависшими задачами')
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_bounded(func: Callable[[T], R], items: Iterable[T], workers: int, timeout: float,
+                callback: Optional[Callable[[int, Optional[R], Optional[Exception]], None]] = None,
+                before: Optional[Callable[[T], None]] = None) -> List[Tuple[Optional[R], Optional[Exception]]]:
+    """ То же, что iter_bounded, но возвращает пары (результат, исключение) в порядке элементов
+    callback(индекс, результат, исключение) вызывается по мере готовности каждого элемента.
+    """
+    items = list(items)
+    results: List[Tuple[Optional[R], Optional[Exception]]] = [(None, None)] * len(items)
+
+    for i, result, error in iter_bounded(func, items, workers, timeout, before):
+        results[i] = (result, error)
+        if callback is not None:
+            callback(i, result, error)
+
+    return results
+
+
+class RateLimiter(object):
+    """ Ограничение частоты обращений отдельно для каждого ключа (например, УТМ): не чаще rate раз в секунду
+    wait() резервирует ближайшее свободное время для ключа и ждет его, поэтому потоки выстраиваются в очередь
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next: Dict[Hashable, float] = {}
+        self._lock = threading.Lock()
+
+    def wait(self, key: Hashable):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(key, now))
+            self._next[key] = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
@@ -0,0 +1,127 @@
+import logging
+import os
+import uuid
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from string import Template
+from typing import Dict, Optional
+from xml.sax.saxutils import escape
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+# Поля шаблонов: путь по именам тегов без пространств имен от корня -> имя подстановки
+PLACEHOLDERS = {
+    'ttn.xml': {
+        'Owner/FSRAR_ID': 'fsrar',
+        'Document/QueryResendDoc/Parameters/Parameter/Value': 'wbregid',
+    },
+    'nattn.xml': {
+        'Owner/FSRAR_ID': 'fsrar',
+        'Document/QueryNATTN/Parameters/Parameter/Value': 'code',
+    },
+    'queryfilter.xml': {
+        'Owner/FSRAR_ID': 'fsrar',
+        'Document/QueryFilter/bc': 'mark',
+    },
+    'reject.xml': {
+        'Owner/FSRAR_ID': 'fsrar',
+        'Document/WayBillAct_v3/Header/IsAccept': 'is_accept',
+        'Document/WayBillAct_v3/Header/ActDate': 'date',
+        'Document/WayBillAct_v3/Header/WBRegId': 'wbregid',
+    },
+    'wbrepeal.xml': {
+        'Owner/FSRAR_ID': 'fsrar',
+        'Document/RequestRepealWB/ClientId': 'fsrar',
+        'Document/RequestRepealWB/RequestDate': 'date',
+        'Document/RequestRepealWB/WBRegId': 'regid',
+    },
+    'acorepeal.xml': {
+        'Owner/FSRAR_ID': 'fsrar',
+        'Document/RequestRepealACO/ClientId': 'fsrar',
+        'Document/RequestRepealACO/RequestDate': 'date',
+        'Document/RequestRepealACO/ACORegId': 'regid',
+    },
+    'aworepeal.xml': {
+        'Owner/FSRAR_ID': 'fsrar',
+        'Document/RequestRepealAWO/ClientId': 'fsrar',
+        'Document/RequestRepealAWO/RequestDate': 'date',
+        'Document/RequestRepealAWO/AWORegId': 'regid',
+    },
+    'wbrepealconfirm.xml': {
+        'Owner/FSRAR_ID': 'fsrar',
+        'Document/ConfirmRepealWB/Header/IsConfirm': 'is_confirm',
+        'Document/ConfirmRepealWB/Header/ConfirmDate': 'date',
+        'Document/ConfirmRepealWB/Header/WBRegId': 'wbregid',
+        'Document/ConfirmRepealWB/Header/Note': 'is_confirm',
+    },
+}
+
+
+def local_tag(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def find_local(root: ET.Element, path: str) -> ET.Element:
+    """ Элемент по пути из имен тегов без пространств имен, берется первый подходящий на каждом уровне """
+    elem = root
+    for name in path.split('/'):
+        elem = next((child for child in elem if local_tag(child.tag) == name), None)
+        if elem is None:
+            raise KeyError(f'{path}: нет тега {name}')
+    return elem
+
+
+def compile_template(filename: str, placeholders: Dict[str, str]) -> Template:
+    """ Разбор шаблона и замена полей на $имя, результат - строка документа для string.Template """
+    root = ET.parse(filename).getroot()
+    for elem in root.iter():
+        if elem.text and '$' in elem.text:
+            elem.text = elem.text.replace('$', '$$')
+
+    for path, name in placeholders.items():
+        find_local(root, path).text = f'${{{name}}}'
+
+    return Template(XML_DECLARATION + ET.tostring(root, encoding='unicode'))
+
+
+class XmlTemplates(object):
+    """ Шаблоны исходящих документов ЕГАИС, разбираются один раз при старте
+    Документ собирается подстановкой экранированных значений и передается в УТМ из памяти,
+    копия в архив (archive_folder) пишется в фоновом потоке, если архив включен
+    """
+
+    def __init__(self, folder: str, archive_folder: Optional[str] = None):
+        self.archive_folder = archive_folder
+        self.templates: Dict[str, Template] = {}
+
+        for name in sorted(os.listdir(folder)):
+            if name.endswith('.xml'):
+                self.templates[name] = compile_template(os.path.join(folder, name), PLACEHOLDERS.get(name, {}))
+
+        self._archive = ThreadPoolExecutor(max_workers=1) if archive_folder else None
+
+    def render(self, name: str, **values) -> bytes:
+        """ Документ по шаблону, отсутствующая подстановка вызывает KeyError """
+        document = self.templates[name].substitute({k: escape(str(v)) for k, v in values.items()})
+        return document.encode('utf-8')
+
+    def files(self, name: str, data: bytes, prefix: str) -> dict:
+        """ Документ для отправки в УТМ формой xml_file """
+        self.archive(data, prefix)
+        return {'xml_file': (name, BytesIO(data), 'application/xml')}
+
+    def render_files(self, name: str, prefix: str, **values) -> dict:
+        return self.files(name, self.render(name, **values), prefix)
+
+    def archive(self, data: bytes, prefix: str):
+        if self._archive is not None:
+            self._archive.submit(self._write, os.path.join(self.archive_folder, f'{prefix}_{uuid.uuid4()}.xml'), data)
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        try:
+            with open(path, 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            logging.error(f'Не удалось сохранить документ {path}: {e}')